@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+from database import DB
+from find_path import Coordinates, Path
+from routing import NoPath, Workspace
+
+from pytictoc import TicToc
+
+t = TicToc()
+
+# Alternative routes from the plateaus of two search trees, one from the
+# source and one from the target, see the readme. An alternative may cost
+# at most 1 + stretch times the cost of the best route, and may share at
+# most max_overlap of its length with any route found before.
+stretch = 0.25
+max_overlap = 0.5
+
+
+def route_stats(G, nodes):
+    edges = [G.edge(m, n) for m, n in zip(nodes[:-1], nodes[1:])]
+    lengths = {
+        (min(m, n), max(m, n)): float(G.length[e])
+        for m, n, e in zip(nodes[:-1], nodes[1:], edges)
+    }
+    stats = {
+        "cost": sum(G.edge_cost(e) for e in edges),
+        "length": sum(lengths.values()),
+    }
+    return stats, lengths
+
+
+def plateaus(forward, backward, reached):
+    # An edge u-v that is in both trees, with u the parent of v in the
+    # tree from the source and v the parent of u in the tree from the
+    # target, lies on a plateau: a path that is a cheapest path from both
+    # sides. Every node of a plateau gives the same route via that node.
+    # Return the plateaus as (length, first node), longest first.
+    follows = {}
+    for v in reached:
+        u = forward.parent[v]
+        if u != -1 and backward.settled[u] and backward.parent[u] == v:
+            follows[u] = v
+    result = []
+    for first in set(follows) - set(follows.values()):
+        last = first
+        while last in follows:
+            last = follows[last]
+        length = forward.length[last] - forward.length[first]
+        result.append((length, first))
+    return sorted(result, reverse=True)
+
+
+def find_alternatives(G, source, target, k=3):
+    # The best route and up to k - 1 clearly different alternatives, each
+    # as a list of nodes and a dict with its statistics. One search from
+    # the target finds the cost of the best route; then a search from the
+    # source and one from the target, both bounded by the largest cost an
+    # alternative may have, give all routes. The search from the target
+    # that finds the best cost simply continues up to this bound.
+    t.tic()
+    forward, backward = Workspace(G), Workspace(G)
+    backward.search(target, targets=[source])
+    if not backward.settled[source]:
+        raise NoPath(f"No path from {source} to {target}")
+    best_cost = backward.cost[source]
+    bound = (1 + stretch) * best_cost
+    reached = forward.search(source, max_cost=bound)
+    backward.resume(max_cost=bound)
+
+    # The longest plateau is the best route itself.
+    routes = []
+    for _, via in plateaus(forward, backward, reached):
+        if len(routes) == k:
+            break
+        if forward.cost[via] + backward.cost[via] > bound:
+            continue
+        nodes = forward.nodes_to(via) + backward.nodes_to(via)[-2::-1]
+        if len(set(nodes)) < len(nodes):
+            continue  # the route passes a node twice
+        stats, lengths = route_stats(G, nodes)
+        shared = [
+            sum(lengths[e] for e in lengths.keys() & other.keys())
+            for _, _, other in routes
+        ]
+        if shared and max(shared) > max_overlap * stats["length"]:
+            continue
+        stats["stretch"] = stats["cost"] / best_cost
+        stats["overlap"] = max(shared, default=0) / stats["length"]
+        routes.append((nodes, stats, lengths))
+    print(f"{len(routes)} routes, {len(reached)} nodes settled from source")
+    t.toc()
+    return [(nodes, stats) for nodes, stats, _ in routes]
+
+
+def main():
+    # Alternatives from the first to the last point of A_to_B.
+    from my_walks import A_to_B
+
+    db = DB()
+    coordinates = Coordinates(db)
+    best = Path(db, coordinates, A_to_B)
+    best.get_graph_data()
+    route = best.snap_waypoints()
+    for i, (nodes, stats) in enumerate(
+        find_alternatives(best.G, route[0], route[-1])
+    ):
+        print(
+            f"route {i}: {int(stats['length'])} m, "
+            f"{100 * max(stats['stretch'] - 1, 0):.0f}% more expensive, "
+            f"{100 * stats['overlap']:.0f}% shared"
+        )
+        path = Path(db, coordinates, A_to_B)
+        path.G = best.G
+        path.name = f"{A_to_B.name}_alternative_{i}"
+        path.follow(nodes)
+        path.plot()
+        path.print_stats()
+        path.write_path_to_kml()
+    db.close_connection()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+import argparse
+import csv
+import json
+from multiprocessing import Pool
+import os
+from types import SimpleNamespace
+
+import common
+from database import DB
+from find_path import Coordinates, Path
+from routing import NoPath
+
+from pytictoc import TicToc
+
+t = TicToc()
+
+# Route many walks at once. The walks are in a json file that maps the name
+# of each walk to the list of its waypoints, as (latitude, longitude):
+#
+#   {"club_walk_1": [[52.09, 5.12], [52.05, 5.18]], ...}
+#
+# The graph, hierarchy and snap index are memory mapped files, so the
+# workers share the pages of the operating system and none of them holds
+# a copy of the graph; each worker only opens them once.
+write_kml = True
+
+worker = {}
+
+
+def init_worker(method, out_dir):
+    db = DB()
+    worker["db"] = db
+    worker["coordinates"] = Coordinates(db)
+    worker["method"] = method
+    worker["out_dir"] = out_dir
+
+
+def route(job):
+    # A walk that fails gets an error in its result, so that the other
+    # walks of the batch are still routed.
+    name, waypoints = job
+    if len(waypoints) < 2:
+        return {"name": name, "error": "a walk needs at least two waypoints"}
+    walk = SimpleNamespace(
+        name=os.path.join(worker["out_dir"], name),
+        coordinates=waypoints,
+        node_ids=[],
+    )
+    path = Path(
+        worker["db"], worker["coordinates"], walk, method=worker["method"]
+    )
+    try:
+        path.compute_shortest_path()
+        if write_kml:
+            path.write_path_to_kml()
+        return {"name": name, **path.stats()}
+    except NoPath as e:
+        return {"name": name, "error": str(e)}
+    except Exception as e:
+        return {"name": name, "error": f"{type(e).__name__}: {e}"}
+
+
+def write_summary(results, fname):
+    # A json summary has all statistics, a csv summary a column per tag.
+    if fname.endswith(".json"):
+        with open(fname, "w") as fp:
+            json.dump(results, fp, indent=1)
+        return
+    fields = ["name", "length", "cost", "near_primary", "near_trunk", "error"]
+    fields += [f"length_{tag}" for tag in common.tags]
+    with open(fname, "w", newline="") as fp:
+        writer = csv.DictWriter(fp, fieldnames=fields, restval="")
+        writer.writeheader()
+        for r in results:
+            row = {k: v for k, v in r.items() if not isinstance(v, dict)}
+            for tag, length in r.get("length_per_tag", {}).items():
+                row[f"length_{tag}"] = length
+            writer.writerow(row)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Route many walks at once.")
+    parser.add_argument("walks", help="json file with the walks")
+    parser.add_argument("summary", help="csv or json file for the statistics")
+    parser.add_argument(
+        "--out-dir", default=".", help="directory for the kml files"
+    )
+    parser.add_argument("--processes", type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    with open(args.walks) as fp:
+        jobs = list(json.load(fp).items())
+    method = "ch" if os.path.exists(common.ch_dir) else "astar"
+    t.tic()
+    with Pool(
+        args.processes, initializer=init_worker, initargs=(method, args.out_dir)
+    ) as pool:
+        results = pool.map(route, jobs, chunksize=1)
+    write_summary(results, args.summary)
+    failed = sum("error" in r for r in results)
+    print(f"{len(results)} walks routed, {failed} failed")
+    t.toc()
+
+
+if __name__ == '__main__':
+    main()
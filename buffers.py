@@ -0,0 +1,26 @@
+import numpy as np
+
+
+class Buffer:
+    # A numpy array to which we can append, for instance in an osmium
+    # handler. The capacity doubles when the buffer is full, so the memory
+    # stays within a factor 2 of the data.
+    def __init__(self, dtype, capacity=1 << 16):
+        self._data = np.empty(capacity, dtype=dtype)
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def extend(self, values):
+        values = np.asarray(values, dtype=self._data.dtype)
+        end = self._size + len(values)
+        if end > len(self._data):
+            data = np.empty(max(end, 2 * len(self._data)), dtype=self._data.dtype)
+            data[: self._size] = self._data[: self._size]
+            self._data = data
+        self._data[self._size : end] = values
+        self._size = end
+
+    def array(self):
+        return self._data[: self._size]
@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+from collections import defaultdict
+import heapq
+import os
+from math import inf
+import numpy as np
+
+import common
+from graph import Graph
+from routing import NoPath, unwind
+
+from pytictoc import TicToc
+
+t = TicToc()
+
+# A witness search gives up after settling this many nodes. Giving up
+# early only adds superfluous shortcuts, it never gives wrong paths.
+witness_limit = 50
+
+
+class ContractionHierarchy:
+    # A contraction hierarchy contracts the nodes one by one in the order
+    # given by rank.  When node v is contracted, a shortcut u-w is added
+    # between two of its remaining neighbors u and w, unless there is a
+    # path from u to w without v that is not more expensive. The upward
+    # graph keeps for every node v the edges to the neighbors that were
+    # still present when v was contracted, i.e., neighbors of higher rank.
+    # For a shortcut, middle is the contracted node it passes; for an
+    # original edge middle is -1.
+    arrays = ["rank", "offsets", "neighbors", "cost", "middle"]
+
+    def __init__(self, directory=common.ch_dir, mmap_mode="r"):
+        for name in self.arrays:
+            fname = os.path.join(directory, name + ".npy")
+            setattr(self, name, np.load(fname, mmap_mode=mmap_mode))
+
+    def adjacent(self, i):
+        start, stop = self.offsets[i], self.offsets[i + 1]
+        return self.neighbors[start:stop], self.cost[start:stop]
+
+    def middle_of(self, m, n):
+        if self.rank[m] > self.rank[n]:
+            m, n = n, m
+        start, stop = self.offsets[m], self.offsets[m + 1]
+        k = np.flatnonzero(self.neighbors[start:stop] == n)
+        return int(self.middle[start + k[0]])
+
+    def unpack(self, path):
+        # Replace each shortcut by the two edges it consists of, until
+        # only original edges remain.
+        nodes = [path[0]]
+        stack = list(zip(path[:-1], path[1:]))[::-1]
+        while stack:
+            m, n = stack.pop()
+            middle = self.middle_of(m, n)
+            if middle == -1:
+                nodes.append(n)
+            else:
+                stack += [(middle, n), (m, middle)]
+        return nodes
+
+    def shortest_path(self, source, target):
+        # Both searches only go up in rank. A search may stop once its
+        # smallest key is not less than the cost of the best path so far.
+        dist = [{source: 0.0}, {target: 0.0}]
+        pred = [{source: -1}, {target: -1}]
+        heaps = [[(0.0, source)], [(0.0, target)]]
+        best, meet = inf, -1
+        settled = 0
+        while heaps[0] or heaps[1]:
+            if not heaps[1] or heaps[0] and heaps[0][0] <= heaps[1][0]:
+                side = 0
+            else:
+                side = 1
+            d, u = heapq.heappop(heaps[side])
+            if d > dist[side][u]:
+                continue
+            if d >= best:
+                heaps[side] = []
+                continue
+            settled += 1
+            if u in dist[1 - side] and d + dist[1 - side][u] < best:
+                best, meet = d + dist[1 - side][u], u
+            nbrs, costs = self.adjacent(u)
+            for v, c in zip(nbrs.tolist(), costs.tolist()):
+                if d + c < dist[side].get(v, inf):
+                    dist[side][v] = d + c
+                    pred[side][v] = u
+                    heapq.heappush(heaps[side], (d + c, v))
+        if meet == -1:
+            raise NoPath(f"No path from {source} to {target}")
+        path = unwind(pred[0], meet) + unwind(pred[1], meet)[-2::-1]
+        return self.unpack(path), settled
+
+    def upward_search(self, source):
+        # The costs of the cheapest upward paths from source to all nodes
+        # that such paths reach.
+        dist = {source: 0.0}
+        heap = [(0.0, source)]
+        while heap:
+            d, u = heapq.heappop(heap)
+            if d > dist[u]:
+                continue
+            nbrs, costs = self.adjacent(u)
+            for v, c in zip(nbrs.tolist(), costs.tolist()):
+                if d + c < dist.get(v, inf):
+                    dist[v] = d + c
+                    heapq.heappush(heap, (d + c, v))
+        return dist
+
+    def cost_matrix(self, sources, targets):
+        # A cheapest path from s to t goes up from s and then down to t,
+        # so it passes through a node v that both upward searches reach.
+        # The upward search from each target leaves the target and its
+        # cost in the bucket of every node it reaches; the upward search
+        # from each source then only needs to scan the buckets of the
+        # nodes it reaches. This takes one small search per source and
+        # target rather than one per pair.
+        buckets = defaultdict(list)
+        for j, target in enumerate(targets):
+            for v, d in self.upward_search(target).items():
+                buckets[v].append((j, d))
+        costs = np.full((len(sources), len(targets)), inf)
+        for i, source in enumerate(sources):
+            row = costs[i]
+            for v, d in self.upward_search(source).items():
+                for j, e in buckets.get(v, []):
+                    if d + e < row[j]:
+                        row[j] = d + e
+        return costs
+
+
+def witness_search(adj, source, avoid, limit):
+    # Cheapest costs from source not via avoid, as far as limit.
+    dist = {source: 0.0}
+    heap = [(0.0, source)]
+    settled = 0
+    while heap and settled < witness_limit:
+        d, u = heapq.heappop(heap)
+        if d > dist[u]:
+            continue
+        if d > limit:
+            break
+        settled += 1
+        for v, (c, _) in adj[u].items():
+            if v != avoid and d + c < dist.get(v, inf):
+                dist[v] = d + c
+                heapq.heappush(heap, (d + c, v))
+    return dist
+
+
+def shortcuts(adj, v):
+    # The shortcuts needed when v would be contracted now.
+    nbrs = [(u, c) for u, (c, _) in adj[v].items()]
+    result = []
+    for i, (u, cost_u) in enumerate(nbrs[:-1]):
+        via_v = {w: cost_u + cost_w for w, cost_w in nbrs[i + 1 :]}
+        dist = witness_search(adj, u, v, max(via_v.values()))
+        result += [(u, w, c) for w, c in via_v.items() if dist.get(w, inf) > c]
+    return result
+
+
+def build_hierarchy(G, directory=common.ch_dir):
+    t.tic()
+    num_nodes = G.number_of_nodes()
+    adj = []
+    for u in range(num_nodes):
+        nbrs, costs = G.adjacent(u)
+        adj.append({v: (c, -1) for v, c in zip(nbrs.tolist(), costs.tolist())})
+
+    # Contract first the nodes whose contraction adds the fewest edges,
+    # and spread the contraction over the graph by counting the already
+    # contracted neighbors.
+    contracted_neighbors = np.zeros(num_nodes, dtype=int)
+
+    def priority(v, new_edges):
+        return len(new_edges) - len(adj[v]) + contracted_neighbors[v]
+
+    heap = [(priority(v, shortcuts(adj, v)), v) for v in range(num_nodes)]
+    heapq.heapify(heap)
+    print("initial node order computed")
+    t.toc()
+
+    rank = np.zeros(num_nodes, dtype=np.int32)
+    up = []  # node, neighbor, cost, middle
+    for r in range(num_nodes):
+        while True:  # lazy updates of the priorities
+            _, v = heapq.heappop(heap)
+            new_edges = shortcuts(adj, v)
+            p = priority(v, new_edges)
+            if not heap or p <= heap[0][0]:
+                break
+            heapq.heappush(heap, (p, v))
+        rank[v] = r
+        for u, w, c in new_edges:
+            if c < adj[u].get(w, (inf, -1))[0]:
+                adj[u][w] = (c, v)
+                adj[w][u] = (c, v)
+        for u, (c, middle) in adj[v].items():
+            up.append((v, u, c, middle))
+            del adj[u][v]
+            contracted_neighbors[u] += 1
+        adj[v] = {}
+        if r % 100000 == 0:
+            print(f"contracted {r} of {num_nodes} nodes")
+
+    up = np.array(
+        up,
+        dtype=[
+            ("node", np.int32),
+            ("neighbor", np.int32),
+            ("cost", np.float64),
+            ("middle", np.int32),
+        ],
+    )
+    up.sort(order="node", kind="stable")
+    offsets = np.zeros(num_nodes + 1, dtype=np.int64)
+    np.cumsum(np.bincount(up["node"], minlength=num_nodes), out=offsets[1:])
+    hierarchy = {
+        "rank": rank,
+        "offsets": offsets,
+        "neighbors": up["neighbor"],
+        "cost": up["cost"],
+        "middle": up["middle"],
+    }
+    os.makedirs(directory, exist_ok=True)
+    for name in ContractionHierarchy.arrays:
+        np.save(os.path.join(directory, name + ".npy"), hierarchy[name])
+    shortcuts_added = (up["middle"] >= 0).sum()
+    print(f"hierarchy with {shortcuts_added} shortcuts written to {directory}")
+    t.toc()
+
+
+def main():
+    G = Graph()
+    build_hierarchy(G)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,28 @@
 # import simplekml.Color = color
 data_dir = "/home/nicky/tmp/pbf/"
 db_name = data_dir + "nodes_and_edges.db"
+snapshot_dir = data_dir + "snapshot/"
+ch_dir = data_dir + "ch/"
+compressed_dir = data_dir + "compressed/"
+snap_dir = data_dir + "snap/"
+tiles_dir = data_dir + "tiles/"
+columns_dir = data_dir + "columns/"
+scenery_file = data_dir + "scenery.npz"
+
+# Where build_snapshot and the snapping without snap index read the nodes
+# and edges tables: "sqlite", or "columns" for the column files in
+# columns_dir, see storage.py.
+storage = "sqlite"
+
+# The graphs that the import builds from the snapshot besides the snap
+# index: "hierarchy" in ch_dir, see ch.py, "compressed" in compressed_dir,
+# see compress.py, and "tiles" in tiles_dir, see tiles.py. The others are
+# removed whenever the snapshot is built again, as they no longer fit it.
+graphs = []
+
+# A gps point farther than max_snap_distance meters from every node of the
+# snap index is not snapped, see snap.py.
+max_snap_distance = 5000
 
 provinces = [
     "groningen",
@@ -52,12 +74,53 @@ primary = {
     "primary_link",
 }
 
+secondary = {
+    "secondary",
+    "secondary_link",
+}
+
 edge_tags = {t: i for i, t in enumerate(tags)}
 trunk_tags = set(edge_tags[t] for t in trunks)
 primary_tags = set(edge_tags[t] for t in primary)
+secondary_tags = set(edge_tags[t] for t in secondary)
 
+# The cost of an edge whose midpoint lies d meters from the nearest trunk
+# is multiplied by 1 + (near_trunk_cost - 1) * exp(-d / near_trunk_distance),
+# and likewise for primary and secondary roads; the largest of these
+# penalties counts. An edge closer than near_trunk_distance to a trunk is
+# marked as near_trunk, and likewise for primary roads.
 near_trunk_cost = 3
 near_primary_cost = 20
+near_secondary_cost = 1
+near_trunk_distance = 100
+near_primary_distance = 20
+near_secondary_distance = 10
+
+# Landuse and natural areas, by the tag that marks them. Around each node
+# we measure which share of the disc of radius scenery_radius meters is
+# covered by each kind of area, on a lattice with scenery_spacing meters
+# between the points. The scenic score of a node is the sum of the shares
+# times the weights below, at most 1, and that of an edge the mean of its
+# nodes. The cost factor of an edge is multiplied by
+# 1 - scenic_discount * scenic.
+scenery = {
+    ("landuse", "forest"): "forest",
+    ("natural", "wood"): "forest",
+    ("natural", "heath"): "heath",
+    ("natural", "water"): "water",
+    ("landuse", "reservoir"): "water",
+    ("landuse", "farmland"): "farmland",
+    ("landuse", "meadow"): "farmland",
+}
+scenery_weight = {
+    "forest": 1,
+    "heath": 1,
+    "water": 0.5,
+    "farmland": 0.2,
+}
+scenery_spacing = 50
+scenery_radius = 250
+scenic_discount = 0.2
 
 cost_factor = {
     'steps': 1,
@@ -79,6 +142,55 @@ cost_factor = {
     'service': 2,
 }
 
+# Named cost profiles for the router. A tag without a cost factor can not
+# be used by the profile. The default profile gives the costs of the
+# cost column of the edges table.
+cost_profiles = {
+    "default": {
+        "cost_factor": cost_factor,
+        "near_trunk_cost": near_trunk_cost,
+        "near_primary_cost": near_primary_cost,
+        "near_secondary_cost": near_secondary_cost,
+        "scenic_discount": scenic_discount,
+    },
+    "forest-lover": {
+        "cost_factor": {
+            **cost_factor,
+            'footway': 1.3,
+            'cycleway': 2,
+            'residential': 2,
+            'unclassified': 2,
+            'living_street': 3,
+            'pedestrian': 2,
+            'service': 3,
+            'tertiary': 4,
+            'tertiary_link': 4,
+            'secondary': 6,
+            'secondary_link': 6,
+        },
+        "near_trunk_cost": 6,
+        "near_primary_cost": 30,
+        "near_secondary_cost": 2,
+        "scenic_discount": 0.5,
+    },
+    "fastest": {
+        "cost_factor": {t: 1 for t in cost_factor},
+        "near_trunk_cost": 1,
+        "near_primary_cost": 1,
+    },
+    "wheelchair": {
+        "cost_factor": {
+            t: f
+            for t, f in cost_factor.items()
+            if t not in {'steps', 'path', 'bridleway'}
+        }
+        | {'track': 3},
+        "near_trunk_cost": near_trunk_cost,
+        "near_primary_cost": near_primary_cost,
+        "scenic_discount": scenic_discount,
+    },
+}
+
 
 tag_to_color = {
     'path': "black",
@@ -1,104 +1,258 @@
 #!/usr/bin/env python
-import sqlite3
-import networkx as nx
+import heapq
+import os
+from math import inf
+import numpy as np
 
-import common as c
+import common
+from graph import Graph, to_csr
+from routing import NoPath, unwind
 
+from pytictoc import TicToc
 
-def compress():
-    G = nx.Graph()
-    trunk_tags = ",".join(str(t) for t in c.trunk_tags)
-    sql = (
-        "SELECT  node_from, node_to, cost "
-        "FROM highways "
-        f"WHERE tag NOT IN ({trunk_tags});"
-    )
-    cur.execute(sql)
-    for e in cur.fetchall():
-        node_from, node_to, cost = e
-        G.add_edge(node_from, node_to, cost=cost)
-    return G  # don't compress
-
-    # dead ends can be removed straight away
-    print(G.number_of_nodes())
-    nodes = set(n for n in G.nodes() if G.degree(n) == 1)
-    while nodes:
-        m = nodes.pop()
-        while G.degree(m) == 1:
-            n = list(G.neighbors(m))[0]
-            G.remove_node(m)
-            m = n
-    print(G.number_of_nodes())
-    # contract highways
-    nodes = set(n for n in G.nodes() if G.degree(n) <= 2)
-    num_passes = 0
-    while nodes and num_passes < 5:
-        for node in nodes:
-            if G.degree(node) <= 1:  # remove dead end
-                G.remove_node(node)
+t = TicToc()
+
+
+class CompressedGraph:
+    # The snapshot graph without dead ends and with every chain of degree
+    # 2 nodes replaced by a single edge. The remaining nodes are the core
+    # nodes, core[i] is the snapshot node of core node i and core_index is
+    # the inverse, with -1 for removed nodes. The edges form a csr graph
+    # like the snapshot; the snapshot nodes a compressed edge passes are
+    # via_nodes[via_offsets[k]:via_offsets[k + 1]] with k its chain,
+    # ordered from the core node with the lower number to the higher.
+    arrays = [
+        "core",
+        "core_index",
+        "offsets",
+        "neighbors",
+        "cost",
+        "chain",
+        "via_offsets",
+        "via_nodes",
+    ]
+
+    def __init__(self, G, directory=common.compressed_dir):
+        self.G = G
+        for name in self.arrays:
+            fname = os.path.join(directory, name + ".npy")
+            setattr(self, name, np.load(fname, mmap_mode="r"))
+
+    def number_of_nodes(self):
+        return len(self.core)
+
+    def number_of_edges(self):
+        return len(self.neighbors) // 2
+
+    def adjacent(self, i):
+        start, stop = self.offsets[i], self.offsets[i + 1]
+        return self.neighbors[start:stop], self.cost[start:stop]
+
+    def unpack(self, m, n):
+        # The snapshot nodes of the compressed edge m-n, without m.
+        start, stop = self.offsets[m], self.offsets[m + 1]
+        k = np.flatnonzero(self.neighbors[start:stop] == n)[0]
+        chain = self.chain[start + k]
+        via = self.via_nodes[self.via_offsets[chain] : self.via_offsets[chain + 1]]
+        if m > n:
+            via = via[::-1]
+        return via.tolist() + [int(self.core[n])]
+
+    def local_search(self, source):
+        # Dijkstra in the snapshot from source that does not pass core
+        # nodes. When source is removed, this explores the dead end or
+        # chain it lies on, and finds the core nodes through which the
+        # cheapest paths leave it.
+        dist = {source: 0.0}
+        pred = {source: -1}
+        if self.core_index[source] >= 0:
+            return dist, pred
+        heap = [(0.0, source)]
+        while heap:
+            d, u = heapq.heappop(heap)
+            if d > dist[u] or self.core_index[u] >= 0:
+                continue
+            nbrs, costs = self.G.adjacent(u)
+            for v, c in zip(nbrs.tolist(), costs.tolist()):
+                if d + c < dist.get(v, inf):
+                    dist[v] = d + c
+                    pred[v] = u
+                    heapq.heappush(heap, (d + c, v))
+        return dist, pred
+
+    def shortest_path(self, source, target):
+        # Source and target are snapshot nodes, and so is the path.
+        dist_s, pred_s = self.local_search(source)
+        dist_t, pred_t = self.local_search(target)
+        settled = len(dist_s) + len(dist_t)
+        entries = {
+            int(self.core_index[u]): d
+            for u, d in dist_s.items()
+            if self.core_index[u] >= 0
+        }
+        exits = {
+            int(self.core_index[u]): d
+            for u, d in dist_t.items()
+            if self.core_index[u] >= 0
+        }
+        # source and target may lie on the same dead end or chain
+        best, meet = dist_s.get(target, inf), -1
+
+        dist = dict(entries)
+        pred = {c: -1 for c in entries}
+        heap = [(d, c) for c, d in entries.items()]
+        heapq.heapify(heap)
+        while heap:
+            d, u = heapq.heappop(heap)
+            if d > dist[u]:
                 continue
-            e1, e2 = G.edges(node)
-            cost = G.get_edge_data(*e1)['cost'] + G.get_edge_data(*e2)['cost']
-            if G.has_edge(e1[1], e2[1]):
-                cost = min(cost, G.get_edge_data(e1[1], e2[1])['cost'])
-            G.add_edge(e1[1], e2[1], cost=cost)
-            G.remove_node(node)
-        nodes = set(n for n in G.nodes() if G.degree(n) <= 2)
-        num_passes += 1
-        print(G.number_of_nodes())
-
-    return G
-
-
-def write_to_db(G):
-    for e in G.edges:
-        cost = G.get_edge_data(*e)['cost']
-        sql = (
-            "INSERT OR IGNORE INTO compressed("
-            "node_from, node_to, cost) VALUES"
-            f"({e[0]}, {e[1]}, {cost})"
-        )
-        cur.execute(sql)
-    conn.commit()
-
-
-def drop_table():
-    cur.execute('''DROP TABLE compressed;''')
-    conn.commit()
-
-
-def make_table():
-    sql = (
-        "CREATE TABLE compressed ("
-        "id INTEGER PRIMARY KEY,"
-        "node_from int,"
-        "node_to int,"
-        "cost int default 0,"
-        "UNIQUE(node_from, node_to)"
-        ");"
+            if d >= best:
+                break
+            settled += 1
+            if u in exits and d + exits[u] < best:
+                best, meet = d + exits[u], u
+            nbrs, costs = self.adjacent(u)
+            for v, c in zip(nbrs.tolist(), costs.tolist()):
+                if d + c < dist.get(v, inf):
+                    dist[v] = d + c
+                    pred[v] = u
+                    heapq.heappush(heap, (d + c, v))
+
+        if best == inf:
+            raise NoPath(f"No path from {source} to {target}")
+        if meet == -1:
+            return unwind(pred_s, target), settled
+        core_path = unwind(pred, meet)
+        path = unwind(pred_s, int(self.core[core_path[0]]))
+        for m, n in zip(core_path[:-1], core_path[1:]):
+            path += self.unpack(m, n)
+        path += unwind(pred_t, int(self.core[meet]))[-2::-1]
+        return path, settled
+
+
+def edge_positions(offsets, nodes):
+    # Positions in the csr edge arrays of all edges of the given nodes.
+    starts, stops = offsets[nodes], offsets[nodes + 1]
+    lengths = stops - starts
+    shift = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+    return shift + np.arange(lengths.sum())
+
+
+def remove_dead_ends(G):
+    # Peel off nodes of degree 1 until none are left; all dead ends of a
+    # round are removed at once.
+    offsets = np.asarray(G.offsets)
+    neighbors = np.asarray(G.neighbors)
+    degree = np.diff(offsets)
+    alive = np.ones(G.number_of_nodes(), dtype=bool)
+    dead_ends = np.flatnonzero(degree <= 1)
+    while len(dead_ends) > 0:
+        alive[dead_ends] = False
+        np.subtract.at(degree, neighbors[edge_positions(offsets, dead_ends)], 1)
+        dead_ends = np.flatnonzero(alive & (degree <= 1))
+    return alive, degree
+
+
+def contract_chains(G, alive, degree):
+    # Walk from every core node along each of its edges until the next
+    # core node. All walks make their steps at the same time.
+    src = np.repeat(np.arange(G.number_of_nodes()), np.diff(G.offsets))
+    dst = np.asarray(G.neighbors)
+    cost = np.asarray(G.cost)
+    keep = alive[src] & alive[dst]
+    src, dst, cost = src[keep], dst[keep], cost[keep]
+    is_core = alive & (degree != 2)
+
+    # the positions of the two edges of each node on a chain
+    first = np.searchsorted(src, np.arange(G.number_of_nodes()))
+    second = np.minimum(first + 1, len(src) - 1)
+
+    walks = np.flatnonzero(is_core[src])
+    start, prev, cur = src[walks], src[walks], dst[walks]
+    total = cost[walks]
+    via_walk, via_node, via_step = [], [], []
+    active = np.flatnonzero(~is_core[cur])
+    step = 0
+    while len(active) > 0:
+        p, c = prev[active], cur[active]
+        via_walk.append(active)
+        via_node.append(c)
+        via_step.append(np.full(len(active), step))
+        edge = np.where(dst[first[c]] == p, second[c], first[c])
+        total[active] += cost[edge]
+        prev[active], cur[active] = c, dst[edge]
+        active = active[~is_core[cur[active]]]
+        step += 1
+    end = cur
+
+    # Every chain is found from both of its ends. Keep the cheapest chain
+    # between each pair of core nodes, and drop loops.
+    low, high = np.minimum(start, end), np.maximum(start, end)
+    order = np.lexsort((total, high, low))
+    order = order[low[order] != high[order]]
+    new_pair = np.ones(len(order), dtype=bool)
+    new_pair[1:] = (low[order][1:] != low[order][:-1]) | (
+        high[order][1:] != high[order][:-1]
+    )
+    kept = order[new_pair]
+    chain = np.full(len(walks), -1)
+    chain[kept] = np.arange(len(kept))
+
+    # Order the via nodes of each chain from low to high.
+    empty = [np.zeros(0, dtype=np.int64)]
+    via_walk = np.concatenate(empty + via_walk)
+    via_node = np.concatenate(empty + via_node)
+    via_step = np.concatenate(empty + via_step)
+    selected = chain[via_walk] >= 0
+    via_walk, via_node = via_walk[selected], via_node[selected]
+    via_step = np.where(
+        start[via_walk] == low[via_walk], via_step[selected], -via_step[selected]
     )
-    cur.execute(sql)
-    conn.commit()
+    order = np.lexsort((via_step, chain[via_walk]))
+    via_offsets = np.zeros(len(kept) + 1, dtype=np.int64)
+    np.cumsum(
+        np.bincount(chain[via_walk], minlength=len(kept)), out=via_offsets[1:]
+    )
+
+    core = np.flatnonzero(is_core).astype(np.int32)
+    core_index = np.full(G.number_of_nodes(), -1, dtype=np.int32)
+    core_index[core] = np.arange(len(core))
+    compressed = to_csr(
+        len(core),
+        core_index[low[kept]],
+        core_index[high[kept]],
+        cost=total[kept],
+        chain=np.arange(len(kept), dtype=np.int32),
+    )
+    compressed["core"] = core
+    compressed["core_index"] = core_index
+    compressed["via_offsets"] = via_offsets
+    compressed["via_nodes"] = via_node[order].astype(np.int32)
+    return compressed
 
 
-def main():
-    try:
-        drop_table()
-    except Exception as e:
-        print("ERROR : " + str(e))
-        print("Cannot drop table")
-    try:
-        make_table()
-    except Exception as e:
-        print("ERROR : " + str(e))
-        print("Cannot make table")
+def compress(G, directory=common.compressed_dir):
+    t.tic()
+    alive, degree = remove_dead_ends(G)
+    print(f"removed {G.number_of_nodes() - alive.sum()} nodes on dead ends")
+    t.toc()
+    compressed = contract_chains(G, alive, degree)
+    print(
+        f"compressed {G.number_of_nodes()} nodes and {G.number_of_edges()} edges "
+        f"to {len(compressed['core'])} nodes and "
+        f"{len(compressed['neighbors']) // 2} edges"
+    )
+    t.toc()
+
+    os.makedirs(directory, exist_ok=True)
+    for name in CompressedGraph.arrays:
+        np.save(os.path.join(directory, name + ".npy"), compressed[name])
 
-    G = compress()
-    write_to_db(G)
+
+def main():
+    G = Graph()
+    compress(G)
 
 
 if __name__ == '__main__':
-    conn = sqlite3.connect(c.db_name)
-    cur = conn.cursor()
     main()
-    conn.close()
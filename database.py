@@ -1,40 +1,203 @@
+from contextlib import contextmanager
 import sqlite3
+import numpy as np
 import common as common
 
+# The settings of DB.bulk_load: a write ahead log, no waiting for the disk
+# after each write, temporary tables and index sorts in memory, and a page
+# cache of bulk_cache_size KiB.
+bulk_pragmas = {
+    "journal_mode": "WAL",
+    "synchronous": "OFF",
+    "temp_store": "MEMORY",
+}
+bulk_cache_size = 1 << 20
+
 
 class DB:
-    def __init__(self):
-        self.connection = sqlite3.connect(common.db_name)
+    def __init__(self, read_only=False):
+        # A read only connection may be used by any thread.
+        if read_only:
+            self.connection = sqlite3.connect(
+                f"file:{common.db_name}?mode=ro",
+                uri=True,
+                check_same_thread=False,
+            )
+        else:
+            self.connection = sqlite3.connect(common.db_name)
         self.cursor = self.connection.cursor()
+        self.in_bulk_load = False
 
     def close_connection(self):
         self.connection.close()
 
     def commit(self):
+        # In a bulk load, everything is committed at the end.
+        if not self.in_bulk_load:
+            self.connection.commit()
+
+    @contextmanager
+    def bulk_load(self):
+        # Run the block as a single transaction, with the settings of
+        # bulk_pragmas, and restore the settings afterwards. Tables that
+        # rebuild makes in the block get their unique indexes at the end,
+        # so the rows inserted in the block must be unique already.
         self.connection.commit()
+        pragmas = dict(bulk_pragmas, cache_size=-bulk_cache_size)
+        before = {p: self.execute(f"PRAGMA {p};")[0][0] for p in pragmas}
+        for p, value in pragmas.items():
+            self.execute(f"PRAGMA {p}={value};")
+        self.execute("BEGIN;")
+        self.in_bulk_load = True
+        try:
+            yield self
+            self.make_unique_indexes()
+            self.connection.commit()
+        except BaseException:
+            self.connection.rollback()
+            raise
+        finally:
+            self.in_bulk_load = False
+            for p, value in before.items():
+                self.execute(f"PRAGMA {p}={value};")
 
     def execute(self, statement):
         self.cursor.execute(statement)
         return self.cursor.fetchall()
 
-    def update_old(self, table, ID, **kwargs):
-        sql = f'UPDATE edges SET'
-        for k in kwargs.keys():
-            sql += f" {k}=? "
-        sql += f"WHERE ID=?"
-        print(sql)
-        quit()
-        self.cursor.executemany(sql, zip(*kwargs.values(), ID))
-
     def update(self, sql, args):
         self.cursor.executemany(sql, args)
         self.commit()
 
+    def execute_array(self, statement, dtype):
+        # Like execute, but collect the rows straight into a numpy
+        # structured array, without a list of tuples in between.
+        self.cursor.execute(statement)
+        return np.fromiter(self.cursor, dtype=dtype)
+
+    def make_temp_table(self, name, **columns):
+        # A temporary table with the given numpy arrays as columns,
+        # for set based updates.
+        self.execute(f"DROP TABLE IF EXISTS temp.{name};")
+        self.execute(f"CREATE TEMP TABLE {name} ({', '.join(columns)});")
+        sql = (
+            f"INSERT INTO temp.{name} VALUES "
+            f"({', '.join('?' * len(columns))})"
+        )
+        self.cursor.executemany(
+            sql, zip(*(np.asarray(c).tolist() for c in columns.values()))
+        )
+
+    def update_columns(self, table, ids, **columns):
+        # Set columns of the rows with the given ids in a single update
+        # statement, rather than one statement per row.
+        self.make_temp_table("new_values", id=ids, **columns)
+        self.execute("CREATE INDEX temp.new_values_id ON new_values(id);")
+        assignments = ", ".join(f"{c} = new_values.{c}" for c in columns)
+        sql = (
+            f"UPDATE {table} SET {assignments} "
+            f"FROM temp.new_values WHERE {table}.id = new_values.id;"
+        )
+        self.execute(sql)
+        self.execute("DROP TABLE temp.new_values;")
+        self.commit()
+
+    def make_stage_table(self):
+        # The hash of each stage of the import when it last finished, see
+        # pipeline.py.
+        self.execute(
+            "CREATE TABLE IF NOT EXISTS stages "
+            "(name TEXT PRIMARY KEY, hash TEXT);"
+        )
+        self.commit()
+
+    def get_stages(self):
+        return dict(self.execute("SELECT name, hash FROM stages;"))
+
+    def set_stage(self, name, digest):
+        self.cursor.execute(
+            "INSERT OR REPLACE INTO stages (name, hash) VALUES (?, ?);",
+            (name, digest),
+        )
+        self.commit()
+
+    def forget_stages(self, names):
+        self.cursor.executemany(
+            "DELETE FROM stages WHERE name = ?;", [(n,) for n in names]
+        )
+        self.commit()
+
     def rebuild(self):
         self.drop_edge_table()
         self.drop_node_table()
         self.make_edge_table()
+        self.make_shared_edge_table()
         self.make_node_table()
+        if not self.in_bulk_load:
+            self.make_unique_indexes()
+
+    def make_unique_indexes(self):
+        # The unique constraints of the edges and nodes tables.
+        statements = [
+            (
+                "CREATE UNIQUE INDEX IF NOT EXISTS edges_nodes "
+                "ON edges(node_from, node_to);"
+            ),
+            (
+                "CREATE UNIQUE INDEX IF NOT EXISTS nodes_node_id "
+                "ON nodes(node_id);"
+            ),
+        ]
+        for sql in statements:
+            self.execute(sql)
+        self.commit()
+
+    def make_indexes(self):
+        # Build the indexes once, after the tables have been filled.
+        # The R*Tree contains a box of size zero for each node, keyed
+        # by the id of the node in the nodes table.
+        statements = [
+            "CREATE INDEX IF NOT EXISTS edges_node_from ON edges(node_from);",
+            "CREATE INDEX IF NOT EXISTS edges_node_to ON edges(node_to);",
+            "CREATE INDEX IF NOT EXISTS edges_tag ON edges(tag);",
+            "CREATE INDEX IF NOT EXISTS edges_way_id ON edges(way_id);",
+            (
+                "CREATE INDEX IF NOT EXISTS shared_edges_way_id "
+                "ON shared_edges(way_id);"
+            ),
+            (
+                "CREATE INDEX IF NOT EXISTS shared_edges_nodes "
+                "ON shared_edges(node_from, node_to);"
+            ),
+            "DROP TABLE IF EXISTS node_rtree;",
+            (
+                "CREATE VIRTUAL TABLE node_rtree USING rtree("
+                "id, min_lat, max_lat, min_lon, max_lon);"
+            ),
+            (
+                "INSERT INTO node_rtree "
+                "SELECT id, latitude, latitude, longitude, longitude FROM nodes;"
+            ),
+            "ANALYZE;",
+        ]
+        for sql in statements:
+            self.execute(sql)
+        self.commit()
+
+    def assign_node_indexes(self):
+        # Number the nodes without an idx 0, 1, 2, ..., after the nodes that
+        # already have one, in the order of their node ids. The idx is the
+        # number of the node in the snapshot and the other arrays.
+        start = self.execute("SELECT COALESCE(MAX(idx) + 1, 0) FROM nodes;")[0][0]
+        sql = (
+            "WITH new AS ("
+            "SELECT id, ROW_NUMBER() OVER (ORDER BY node_id) - 1 AS r "
+            "FROM nodes WHERE idx IS NULL) "
+            f"UPDATE nodes SET idx = {start} + new.r "
+            "FROM new WHERE nodes.id = new.id;"
+        )
+        self.execute(sql)
+        self.commit()
 
     def make_edge_table(self):
         sql = (
@@ -43,11 +206,15 @@ class DB:
             "node_from int,"
             "node_to int,"
             "tag int,"
+            "way_id int,"
             "length real default 0.,"
             "near_trunk int default 0,"
             "near_primary int default 0,"
-            "cost real default 0.,"
-            "UNIQUE(node_from, node_to)"
+            "dist_trunk real default 1e6,"
+            "dist_primary real default 1e6,"
+            "dist_secondary real default 1e6,"
+            "scenic real default 0.,"
+            "cost real default 0."
             ");"
         )
         try:
@@ -57,14 +224,28 @@ class DB:
             print("ERROR : " + str(e))
             print("Cannot make edge table")
 
+    def make_shared_edge_table(self):
+        # The ways that share an edge with the way of the edge, with the
+        # nodes in the direction of the edge, see way_segments.
+        sql = (
+            "CREATE TABLE shared_edges ("
+            "way_id int,"
+            "node_from int,"
+            "node_to int,"
+            "tag int"
+            ");"
+        )
+        self.execute(sql)
+        self.commit()
+
     def make_node_table(self):
         sql = (
             "CREATE TABLE nodes "
             "(id INTEGER PRIMARY KEY, "
             "node_id int, "
+            "idx int, "
             "latitude float, "
-            "longitude float, "
-            "UNIQUE(node_id));"
+            "longitude float);"
         )
         try:
             self.execute(sql)
@@ -75,35 +256,38 @@ class DB:
 
     def drop_edge_table(self):
         try:
+            self.execute("DROP TABLE IF EXISTS shared_edges;")
             self.execute('''DROP TABLE edges;''')
-            self.connection.commit()
+            self.commit()
         except Exception as e:
             print("ERROR : " + str(e))
             print("Cannot drop edge table")
 
     def drop_node_table(self):
         try:
+            self.execute("DROP TABLE IF EXISTS node_rtree;")
             self.execute("DROP TABLE nodes;")
             self.commit()
         except Exception as e:
             print("ERROR : " + str(e))
             print("Cannot drop table")
 
-    def add_edge(self, m, n, tag):
+    def add_edges(self, left, right, tags, way_ids):
+        # The edges must be new and unique: in a bulk load the unique index
+        # only comes at the end, where a duplicate fails the whole load.
         sql = (
-            "INSERT OR IGNORE INTO edges("
-            " node_from, node_to, tag) VALUES"
-            f" ({m}, {n}, {tag})"
+            "INSERT INTO edges(node_from, node_to, tag, way_id)"
+            " VALUES (?, ?, ?, ?)"
         )
-        self.cursor.execute(sql)
+        self.cursor.executemany(sql, zip(left, right, tags, way_ids))
         self.commit()
 
-    def add_edges(self, left, right, tags):
+    def add_shared_edges(self, way_ids, left, right, tags):
         sql = (
-            "INSERT OR IGNORE INTO edges(node_from, node_to, tag)"
-            " VALUES (?, ?, ?)"
+            "INSERT INTO shared_edges(way_id, node_from, node_to, tag)"
+            " VALUES (?, ?, ?, ?)"
         )
-        self.cursor.executemany(sql, zip(left, right, tags))
+        self.cursor.executemany(sql, zip(way_ids, left, right, tags))
         self.commit()
 
     def add_node(self, Id, lat, lon):
@@ -115,43 +299,11 @@ class DB:
         self.execute(sql)
 
     def add_nodes(self, ID, lat, lon):
+        # Like add_edges, the nodes must be new and unique.
         sql = (
-            "INSERT OR IGNORE INTO nodes "
+            "INSERT INTO nodes "
             " (node_id, latitude, longitude)"
             f" VALUES (?, ?, ?)"
         )
         self.cursor.executemany(sql, zip(ID, lat, lon))
         self.commit()
-
-    def get_highway_nodes(self):
-        # return the nodes ids of the edges
-        highway_nodes = set()
-        # for m in self.cursor.fetchall():
-        sql = 'SELECT node_to, node_from FROM edges;'
-        for m in self.execute(sql):
-            highway_nodes.update(m)
-        return highway_nodes
-
-    def get_node_info(self, *args, where=""):
-        sql = "SELECT " + ", ".join(a for a in args) + " FROM nodes"
-        if where:
-            sql += f" WHERE {where};"
-        return self.execute(sql)
-
-    def get_edge_info(self, *args, where=""):
-        sql = "SELECT " + ", ".join(a for a in args) + " FROM edges"
-        if where:
-            sql += f" WHERE {where};"
-        return self.execute(sql)
-
-    def get_tagged_coordinates(self, tags):
-        Tags = ",".join(str(t) for t in tags)
-        sql = (
-            "SELECT latitude, longitude "
-            "FROM nodes "
-            "WHERE node_id IN "
-            "(SELECT  node_from "
-            "FROM edges "
-            f"WHERE tag IN ({Tags}));"
-        )
-        return self.execute(sql)
@@ -1,26 +1,75 @@
 #!/usr/bin/env python
 from collections import defaultdict
-from functools import cache
+from functools import cache, partial, wraps
 from itertools import chain
 import numpy as np
 import os.path
 from sklearn.neighbors import KDTree
-import networkx as nx
 import folium
+import gpxpy
 import simplekml
 from pytictoc import TicToc
 
 from database import DB
+from ch import ContractionHierarchy
+from compress import CompressedGraph
+from graph import Graph
+from profiles import Weighted
+from snap import SnapIndex
+from storage import open_storage
+from tiles import TiledGraph
+from routing import cost_matrix, routers
+from tour import best_order
 import common
-from my_walks import A_to_B
 
 t = TicToc()
 
 
+# The memory mapped arrays are opened once per process, and shared by all
+# paths. With mmap_mode None they are read into memory instead.
+mmap_mode = "r"
+
+
+@cache
+def load_graph():
+    return Graph(mmap_mode=mmap_mode)
+
+
+@cache
+def load_hierarchy():
+    return ContractionHierarchy(mmap_mode=mmap_mode)
+
+
+@cache
+def load_snap_index():
+    return SnapIndex(mmap_mode=mmap_mode)
+
+
+def memoize(method):
+    # Like functools.cache, but the results are kept in the object rather
+    # than in the method, so they go when the object goes.
+    @wraps(method)
+    def cached(self, *args):
+        key = (method.__name__, args)
+        if key not in self._cache:
+            self._cache[key] = method(self, *args)
+        return self._cache[key]
+
+    return cached
+
+
 class Coordinates:
-    def __init__(self, db):
-        self._coordinates = {}
+    # The latitude and longitude of node n are in row n of the
+    # memory mapped coordinates array of the snapshot.
+    def __init__(self, db, directory=common.snapshot_dir):
+        self._coordinates = np.load(
+            os.path.join(directory, "coordinates.npy"), mmap_mode="r"
+        )
+        self._offsets = np.load(
+            os.path.join(directory, "offsets.npy"), mmap_mode="r"
+        )
         self.db = db
+        self.storage = open_storage(db)
 
     @classmethod
     def get_containing_rectangle(self, path, eps=0.1):
@@ -31,41 +80,47 @@ class Coordinates:
         return north, west, south, east
 
     def coordinate(self, node):
-        return self._coordinates[node]
-
-    def update(self, nodes):
-        to_update = set(n for n in nodes if n not in self._coordinates)
-        res = ",".join(str(n) for n in to_update)
-        sql = f'SELECT node_id, latitude, longitude FROM nodes WHERE node_id in ({res});'
-        self._coordinates.update(
-            {ID: (la, lo) for ID, la, lo in self.db.execute(sql)}
-        )
+        return tuple(self._coordinates[node].tolist())
+
+    def coordinates(self, nodes):
+        return np.asarray(self._coordinates[nodes])
 
     def find_node_nearby_gps(self, point):
         north, west, south, east = self.get_containing_rectangle(
             [point], eps=0.05
         )
-        sql = (
-            "SELECT node_from FROM edges "
-            "WHERE node_from IN "
-            "(SELECT node_id FROM nodes "
-            f"WHERE latitude BETWEEN {south} AND {north} "
-            f"AND longitude BETWEEN {west} AND {east}) "
+        res = self.storage.nodes(
+            ["idx", "latitude", "longitude"], box=(north, west, south, east)
         )
-        nodes = [n[0] for n in self.db.execute(sql)]
-        self.update(nodes)
-        res = np.array([[n, *self.coordinate(n)] for n in nodes])
-        tree = KDTree(res[:, [1, 2]])
+        # Only a node with an edge in the snapshot can be routed from; the
+        # nodes that update.prune left and the nodes on trunks only have
+        # none.
+        idx = res["idx"]
+        routable = idx < len(self._offsets) - 1
+        routable[routable] = (
+            self._offsets[idx[routable] + 1] > self._offsets[idx[routable]]
+        )
+        res = {c: v[routable] for c, v in res.items()}
+        if len(res["idx"]) == 0:
+            raise ValueError(f"No node with edges near {point}")
+        tree = KDTree(np.column_stack([res["latitude"], res["longitude"]]))
         p = np.array(point).reshape(1, -1)  # reshape required
         dist, ind = tree.query(p, k=1)
-        return int(res[ind][0][0][0])  # lots of unpacking
+        return int(res["idx"][ind[0][0]])
 
 
 class Segment:
     def __init__(self, m, n, G):
         self._nodes = [m, n]
         self.G = G
-        self.tag = self.G[m][n]["tag"]
+        self._cache = {}
+        self.tag = self.edge_data(m, n, "tag")
+
+    def edge(self, m, n):
+        return self.G.edge(m, n)
+
+    def edge_data(self, m, n, attribute):
+        return getattr(self.G, attribute)[self.edge(m, n)]
 
     def nodes(self):
         return self._nodes
@@ -76,26 +131,26 @@ class Segment:
     def append_node(self, n):
         self._nodes.append(n)
 
-    @cache
+    @memoize
     def length(self, condition=""):
         length = 0
         for m, n in zip(self._nodes[:-1], self._nodes[1:]):
-            if condition == "" or self.G[m][n][condition]:
-                length += self.G[m][n]["length"]
+            if condition == "" or self.edge_data(m, n, condition):
+                length += self.edge_data(m, n, "length")
         return length
 
-    @cache
+    @memoize
     def cost(self):
         cost = 0
         for m, n in zip(self._nodes[:-1], self._nodes[1:]):
-            cost += self.G[m][n]["cost"]
+            cost += self.G.edge_cost(self.edge(m, n))
         return cost
 
-    @cache
+    @memoize
     def near_trunk(self):
         return self.length("near_trunk")
 
-    @cache
+    @memoize
     def near_primary(self):
         return self.length("near_primary")
 
@@ -104,32 +159,54 @@ class Segment:
 
 
 class Path:
-    def __init__(self, db, coordinates):
+    def __init__(
+        self,
+        db,
+        coordinates,
+        walk,
+        method="astar",
+        profile=None,
+        reorder=False,
+        round_trip=False,
+    ):
+        # Without a profile, the router uses the cost column of the edges.
+        # With reorder, the waypoints between the first and the last are
+        # visited in the cheapest order we can find; with round_trip the
+        # walk returns to the first waypoint. A walk has a name, and
+        # coordinates or node_ids of its waypoints, like the walks of
+        # my_walks.py.
         self.db = db
         self.coordinates = coordinates
+        self.method = method
+        self.profile = profile
+        self.reorder = reorder
+        self.round_trip = round_trip
+        self.walk = walk
+        self.name = walk.name
         self._segments = []
-        self.G = nx.Graph()
+        self._cache = {}
+        self.G = None
 
     def append(self, segment):
         self._segments.append(segment)
 
-    @cache
+    @memoize
     def length(self):
         return sum(s.length() for s in self._segments)
 
-    @cache
+    @memoize
     def cost(self):
         return sum(s.cost() for s in self._segments)
 
-    @cache
+    @memoize
     def near_trunk(self):
         return sum(s.near_trunk() for s in self._segments)
 
-    @cache
+    @memoize
     def near_primary(self):
         return sum(s.near_primary() for s in self._segments)
 
-    @cache
+    @memoize
     def nodes(self):
         return list(chain.from_iterable(s.nodes() for s in self._segments))
 
@@ -137,53 +214,82 @@ class Path:
         return self._segments
 
     def get_graph_data(self):
-        north, west, south, east = self.coordinates.get_containing_rectangle(
-            A_to_B.coordinates
-        )
-
-        trunk_tags = ",".join(str(t) for t in common.trunk_tags)
-        sql = (
-            "SELECT  node_from, node_to, length, cost, tag, near_trunk, near_primary "
-            "FROM edges "
-            f"WHERE tag NOT IN ({trunk_tags}) "
-            "AND node_from IN "
-            "(SELECT node_id FROM nodes "
-            f"WHERE latitude BETWEEN {south} AND {north} "
-            f"AND longitude BETWEEN {west} AND {east}); "
-        )
-        data = []
-        for e in self.db.execute(sql):
-            node_from, node_to, length, cost, tag, near_trunk, near_primary = e
-            d = {
-                "length": length,
-                "cost": cost,
-                "tag": tag,
-                "near_trunk": near_trunk,
-                "near_primary": near_primary,
-            }
-            data.append([node_from, node_to, d])
-        self.G.add_edges_from(data)
-
-    def compute_shortest_path(self):
-        self.get_graph_data()
-        if A_to_B.node_ids:
-            route = A_to_B.node_ids
+        # The snapshot is memory mapped, so loading it is cheap.
+        self.G = load_graph()
+        if self.profile is not None:
+            self.G = Weighted(self.G, self.profile)
+
+    def snap_waypoints(self):
+        if self.walk.node_ids:
+            return [self.G.index(n) for n in self.walk.node_ids]
+        if os.path.exists(common.snap_dir):
+            route = load_snap_index().nearest(self.walk.coordinates)[0]
+            if np.any(route < 0):
+                raise ValueError(
+                    f"A waypoint is more than {common.max_snap_distance} m "
+                    "away from the graph"
+                )
+            route = route.tolist()
         else:
             route = [
                 self.coordinates.find_node_nearby_gps(p)
-                for p in A_to_B.coordinates
+                for p in self.walk.coordinates
             ]
-            print(f"Node ids of path sketch: {route}")
-        best = []
+        print(f"Node ids of path sketch: {self.G.node_ids[route].tolist()}")
+        return route
+
+    def order_waypoints(self, route):
+        # Fill the cost matrix of the waypoints with the contraction
+        # hierarchy when we route with it, and otherwise with one search
+        # per waypoint.
+        t.tic()
+        if self.method == "ch":
+            costs = load_hierarchy().cost_matrix(route, route)
+        else:
+            costs = cost_matrix(self.G, route, route)
+        order = best_order(costs, self.round_trip)
+        print(f"Order of the waypoints: {order}")
+        t.toc()
+        return [route[i] for i in order]
+
+    def compute_shortest_path(self):
+        self.get_graph_data()
+        route = self.snap_waypoints()
+        if self.profile is not None and self.method in (
+            "ch",
+            "compressed",
+            "tiles",
+        ):
+            raise ValueError(f"{self.method} uses the cost column, not a profile")
+        if self.reorder:
+            route = self.order_waypoints(route)
+        elif self.round_trip:
+            route = route + route[:1]
+        if self.method == "ch":
+            router = load_hierarchy().shortest_path
+        elif self.method == "compressed":
+            router = CompressedGraph(self.G).shortest_path
+        elif self.method == "tiles":
+            tiled = TiledGraph(self.G)
+            tiled.load_corridor(self.coordinates.coordinates(route))
+            router = tiled.shortest_path
+        else:
+            router = partial(routers[self.method], self.G)
+        best, settled = [], 0
         for p, q in zip(route[:-1], route[1:]):
-            best += nx.shortest_path(self.G, p, q, weight="cost")[:-1]
-        # :-1 because end points are the same
+            nodes, n = router(p, q)
+            best += nodes[:-1]  # :-1 because end points are the same
+            settled += n
         best.append(route[-1])
+        print(f"{self.method} settled {settled} nodes")
+        self.follow(best)
 
-        segment = Segment(best[0], best[1], self.G)
+    def follow(self, nodes):
+        # Split the path along the nodes into segments of the same tag.
+        segment = Segment(nodes[0], nodes[1], self.G)
         self.append(segment)
-        for n in best[2:]:
-            tag = self.G[segment.last_node()][n]["tag"]
+        for n in nodes[2:]:
+            tag = segment.edge_data(segment.last_node(), n, "tag")
             if tag == segment.tag:
                 segment.append_node(n)
             else:
@@ -191,46 +297,60 @@ class Path:
                 self.append(segment)
 
     def plot(self):
-        self.coordinates.update(self.nodes())
-
-        res = np.array([self.coordinates.coordinate(n) for n in self.nodes()])
+        res = self.coordinates.coordinates(self.nodes())
         mean_lat, mean_lon = res.mean(axis=0)
         zoom = 12
         myMap = folium.Map(location=[mean_lat, mean_lon], zoom_start=zoom)
 
         for segment in self._segments:
             folium.PolyLine(
-                [self.coordinates.coordinate(n) for n in segment.nodes()],
+                self.coordinates.coordinates(segment.nodes()).tolist(),
                 color=segment.color(),
                 weight=3.5,
                 opacity=1,
             ).add_to(myMap)
-        myMap.save(A_to_B.name + ".html")
+        myMap.save(self.name + ".html")
 
-    def print_stats(self):
+    def stats(self):
+        # The length and cost of the path, in total and per tag.
         length = defaultdict(float)
-        for segment in self._segments:
-            length[segment.tag] += segment.length()
         cost = defaultdict(float)
         for segment in self._segments:
-            cost[segment.tag] += segment.cost()
+            length[common.tags[segment.tag]] += segment.length()
+            cost[common.tags[segment.tag]] += segment.cost()
+        return {
+            "length": self.length(),
+            "cost": self.cost(),
+            "near_primary": self.near_primary(),
+            "near_trunk": self.near_trunk(),
+            "length_per_tag": dict(length),
+            "cost_per_tag": dict(cost),
+        }
 
+    def print_stats(self):
+        stats = self.stats()
+        length, cost = stats["length_per_tag"], stats["cost_per_tag"]
         for k, v in sorted(length.items(), key=lambda x: -x[1]):
-            perc = round(100 * v / self.length())
-            # Cost = round(100 * cost[k] / max(self.cost(), 1))
-            Cost = round(100 * cost[k] / self.cost())
+            perc = round(100 * v / stats["length"])
+            Cost = round(100 * cost[k] / stats["cost"])
+            color = common.tag_to_color[k]
             if v > 0:
                 print(
-                    f"{common.tags[k]:<13}{common.tag_color[k]:<10}{int(v):>4d}{perc:>4d}%{int(cost[k]):>7}{Cost:>4d}%"
+                    f"{k:<13}{color:<10}{int(v):>4d}{perc:>4d}%{int(cost[k]):>7}{Cost:>4d}%"
                 )
 
         print(
-            f"total length: {int(self.length()):<6d} m, total cost: {int(self.cost()):<5d}"
+            f"total length: {int(stats['length']):<6d} m, total cost: {int(stats['cost']):<5d}"
         )
-        print(f"Near primary: {int(self.near_primary())} m")
-        print(f"Near trunk: {int(self.near_trunk())} m")
+        print(f"Near primary: {int(stats['near_primary'])} m")
+        print(f"Near trunk: {int(stats['near_trunk'])} m")
 
     def write_path_to_kml(self):
+        km_lenght = int(self.length() / 1000 + 0.5)  # round to km
+        name = f"{self.name}_{km_lenght}"
+        self.kml().save(name + ".kml")
+
+    def kml(self):
         kml_color_mapper = {
             "black": simplekml.Color.black,
             "blue": simplekml.Color.blue,
@@ -241,56 +361,70 @@ class Path:
             "orange": simplekml.Color.orange,
         }
 
-        km_lenght = int(self.length() / 1000 + 0.5)  # round to km
-        name = f"{A_to_B.name}_{km_lenght}"
-
-        self.coordinates.update(self.nodes())
-        kml = simplekml.Kml(name=A_to_B.name)
+        kml = simplekml.Kml(name=os.path.basename(self.name))
         for segment in self._segments:
             ls = kml.newlinestring()
-            ls.coords = [
-                [
-                    self.coordinates.coordinate(n)[1],
-                    self.coordinates.coordinate(n)[0],
-                ]
-                for n in segment.nodes()
-            ]
+            # kml wants longitude, latitude
+            ls.coords = self.coordinates.coordinates(segment.nodes())[
+                :, ::-1
+            ].tolist()
             ls.style.linestyle.width = 3
             ls.style.linestyle.color = kml_color_mapper[segment.color()]
 
-        kml.save(name + ".kml")
-
-
-def write_path_to_gpx(db, path):
-    "this needs to be updated"
-    import gpxpy
-
-    gpx = gpxpy.gpx.GPX()
-
-    # Create first track in our GPX:
-    gpx_track = gpxpy.gpx.GPXTrack()
-    gpx.tracks.append(gpx_track)
-
-    # Create first segment in our GPX track:
-    gpx_segment = gpxpy.gpx.GPXTrackSegment()
-    gpx_track.segments.append(gpx_segment)
-
-    nodes = get_node_coordinates(db, path)
-    for n in path:
-        p = nodes[n]
-        gpx_segment.points.append(gpxpy.gpx.GPXTrackPoint(p[0], p[1]))
-    with open(A_to_B.name, "w") as fp:
-        fp.write(gpx.to_xml())
+        return kml
+
+    def gpx(self):
+        gpx = gpxpy.gpx.GPX()
+        gpx_track = gpxpy.gpx.GPXTrack(name=os.path.basename(self.name))
+        gpx.tracks.append(gpx_track)
+        gpx_segment = gpxpy.gpx.GPXTrackSegment()
+        gpx_track.segments.append(gpx_segment)
+        for lat, lon in self.coordinates.coordinates(self.nodes()).tolist():
+            gpx_segment.points.append(gpxpy.gpx.GPXTrackPoint(lat, lon))
+        return gpx
+
+    def write_path_to_gpx(self):
+        with open(self.name + ".gpx", "w") as fp:
+            fp.write(self.gpx().to_xml())
+
+    def geojson(self):
+        # A feature per segment, with the tag and its color.
+        features = []
+        for segment in self._segments:
+            coordinates = self.coordinates.coordinates(segment.nodes())
+            features.append(
+                {
+                    "type": "Feature",
+                    "geometry": {
+                        "type": "LineString",
+                        # geojson wants longitude, latitude
+                        "coordinates": coordinates[:, ::-1].tolist(),
+                    },
+                    "properties": {
+                        "tag": common.tags[segment.tag],
+                        "color": segment.color(),
+                        "length": float(segment.length()),
+                    },
+                }
+            )
+        return {"type": "FeatureCollection", "features": features}
 
 
 def main():
+    # my_walks.py holds my own walks; only the main functions import it,
+    # so that batch.py and server.py run without it.
+    from my_walks import A_to_B
+
     db = DB()
     coordinates = Coordinates(db)
-    path = Path(db, coordinates)
+    # Use the contraction hierarchy when it has been built.
+    method = "ch" if os.path.exists(common.ch_dir) else "astar"
+    path = Path(db, coordinates, A_to_B, method=method)
     path.compute_shortest_path()
     path.plot()
     path.print_stats()
     path.write_path_to_kml()
+    path.write_path_to_gpx()
 
     db.close_connection()
 
@@ -0,0 +1,22 @@
+from math import cos, pi, sqrt
+import numpy as np
+
+C = pi / 180
+R = 6378137  # earth radius is meters
+CR = C * R
+latitude_utrecht_domkerk = 52.09
+factor = cos(latitude_utrecht_domkerk * pi / 180) ** 2
+
+
+def distance(lat1, lon1, lat2, lon2):
+    # Flat earth approximation of the haversine distance in meters.
+    # This is good for nearby points in the Netherlands.
+    # Works for floats and for numpy arrays.
+    d2 = (lat1 - lat2) ** 2 + factor * (lon1 - lon2) ** 2
+    return np.sqrt(d2) * CR
+
+
+def project(lat, lon):
+    # Metric x, y coordinates in which the euclidean distance
+    # equals distance() above.
+    return np.asarray(lon) * sqrt(factor) * CR, np.asarray(lat) * CR
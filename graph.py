@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+import os
+import numpy as np
+
+import common
+from database import DB
+from profiles import get_profile
+from storage import open_storage
+
+from pytictoc import TicToc
+
+t = TicToc()
+
+
+class Graph:
+    # The walkable highway graph in compressed sparse row form.
+    # The neighbors of node i are neighbors[offsets[i]:offsets[i + 1]],
+    # and the edge attributes cost, length, tag, and so on, are stored
+    # in arrays aligned with neighbors. Every undirected edge is stored
+    # twice, once for each direction. The nodes are numbered by the idx
+    # column of the nodes table; node_ids maps such a number back to the
+    # OpenStreetMap node id, and coordinates holds the latitude and
+    # longitude of each node. id_order sorts node_ids.
+    arrays = [
+        "offsets",
+        "neighbors",
+        "cost",
+        "length",
+        "tag",
+        "near_trunk",
+        "near_primary",
+        "dist_trunk",
+        "dist_primary",
+        "dist_secondary",
+        "scenic",
+        "node_ids",
+        "id_order",
+        "coordinates",
+    ]
+
+    def __init__(self, directory=common.snapshot_dir, mmap_mode="r"):
+        # memory map, so that nothing is read before it is needed, unless
+        # mmap_mode is None
+        for name in self.arrays:
+            fname = os.path.join(directory, name + ".npy")
+            setattr(self, name, np.load(fname, mmap_mode=mmap_mode))
+        self.latitude = self.coordinates[:, 0]
+        self.longitude = self.coordinates[:, 1]
+
+    def number_of_nodes(self):
+        return len(self.offsets) - 1
+
+    def number_of_edges(self):
+        return len(self.neighbors) // 2
+
+    def index(self, node_id):
+        # The number of the node with this OpenStreetMap node id.
+        k = int(np.searchsorted(self.node_ids, node_id, sorter=self.id_order))
+        if k == len(self.node_ids) or self.node_ids[self.id_order[k]] != node_id:
+            raise KeyError(f"Node {node_id} is not in the graph")
+        return int(self.id_order[k])
+
+    def adjacent(self, i):
+        start, stop = self.offsets[i], self.offsets[i + 1]
+        return self.neighbors[start:stop], self.cost[start:stop]
+
+    def edge_cost(self, e):
+        return float(self.cost[e])
+
+    def min_cost_factor(self):
+        # Each edge costs at least its length times the smallest cost factor
+        # of the default profile, which gives the cost column.
+        return get_profile("default").min_cost_factor()
+
+    def edge(self, m, n):
+        # Position of the edge m-n in the edge arrays.
+        start, stop = self.offsets[m], self.offsets[m + 1]
+        k = np.flatnonzero(self.neighbors[start:stop] == n)
+        if len(k) == 0:
+            raise KeyError(f"No edge between {m} and {n}")
+        return int(start + k[0])
+
+
+def to_csr(num_nodes, node_from, node_to, **attributes):
+    # Turn an undirected edge list into csr arrays.  Parallel edges and
+    # edges in both directions are merged, keeping the cheapest.
+    src = np.concatenate([node_from, node_to])
+    dst = np.concatenate([node_to, node_from])
+    attributes = {k: np.concatenate([v, v]) for k, v in attributes.items()}
+    keep = src != dst  # self loops are useless
+    order = np.lexsort((attributes["cost"][keep], dst[keep], src[keep]))
+    order = np.flatnonzero(keep)[order]
+    src, dst = src[order], dst[order]
+    first = np.ones(len(src), dtype=bool)
+    first[1:] = (src[1:] != src[:-1]) | (dst[1:] != dst[:-1])
+    order = order[first]
+
+    offsets = np.zeros(num_nodes + 1, dtype=np.int64)
+    np.cumsum(np.bincount(src[first], minlength=num_nodes), out=offsets[1:])
+    csr = {"offsets": offsets, "neighbors": dst[first].astype(np.int32)}
+    csr.update({k: v[order] for k, v in attributes.items()})
+    return csr
+
+
+def build_snapshot(db, directory=common.snapshot_dir):
+    # Export the edges and nodes tables, from the storage that
+    # common.storage selects, to memory mappable arrays.
+    t.tic()
+    tables = open_storage(db)
+    nodes = tables.nodes(["idx", "node_id", "latitude", "longitude"])
+    num_nodes = nodes["idx"].max() + 1
+    node_ids = np.full(num_nodes, -1, dtype=np.int64)
+    node_ids[nodes["idx"]] = nodes["node_id"]
+    coordinates = np.zeros((num_nodes, 2))
+    coordinates[nodes["idx"], 0] = nodes["latitude"]
+    coordinates[nodes["idx"], 1] = nodes["longitude"]
+
+    tags = [
+        tag for tag in common.edge_tags.values() if tag not in common.trunk_tags
+    ]
+    edges = tables.edges(
+        [
+            "node_from",
+            "node_to",
+            "cost",
+            "length",
+            "tag",
+            "near_trunk",
+            "near_primary",
+            "dist_trunk",
+            "dist_primary",
+            "dist_secondary",
+            "scenic",
+        ],
+        tags,
+    )
+    # Translate node ids to node numbers, and drop the edges whose nodes
+    # lack coordinates.
+    order = np.argsort(nodes["node_id"])
+    known_ids = nodes["node_id"][order]
+
+    def number(ids):
+        k = np.minimum(np.searchsorted(known_ids, ids), len(known_ids) - 1)
+        return np.where(known_ids[k] == ids, nodes["idx"][order][k], -1)
+
+    src, dst = number(edges["node_from"]), number(edges["node_to"])
+    known = (src >= 0) & (dst >= 0)
+    print("read edges and nodes")
+    t.toc()
+
+    csr = to_csr(
+        num_nodes,
+        src[known],
+        dst[known],
+        **{
+            name: np.asarray(column)[known]
+            for name, column in edges.items()
+            if name not in ("node_from", "node_to")
+        },
+    )
+    csr["node_ids"] = node_ids
+    csr["id_order"] = np.argsort(node_ids).astype(np.int32)
+    csr["coordinates"] = coordinates
+
+    os.makedirs(directory, exist_ok=True)
+    for name in Graph.arrays:
+        np.save(os.path.join(directory, name + ".npy"), csr[name])
+    print(f"snapshot with {num_nodes} nodes written to {directory}")
+    t.toc()
+
+
+def main():
+    db = DB()
+    build_snapshot(db)
+    db.close_connection()
+
+
+if __name__ == '__main__':
+    main()
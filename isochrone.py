@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+from functools import cache
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+import folium
+
+import common
+from database import DB
+from find_path import Coordinates, Path
+from profiles import Weighted
+
+from pytictoc import TicToc
+
+t = TicToc()
+
+# Everything within reach of one or more sources. The csr arrays of the
+# snapshot are a sparse matrix for scipy, whose Dijkstra runs in C, keeps
+# its frontier in arrays, and stops at the bound. The matrix is made once
+# per graph and profile, see weight_matrix.
+walking_distance = 10000
+
+
+def edge_weights(G, by):
+    if by == "length":
+        return np.asarray(G.length)
+    if hasattr(G, "edge_weights"):  # a profile
+        return G.edge_weights(slice(None))
+    return np.asarray(G.cost)
+
+
+@cache
+def weight_matrix(G, profile, by):
+    # The sparse matrix of the snapshot G with the weights of the profile,
+    # built once per graph, profile and kind of weight, since it takes
+    # time in the number of edges, while a query with a small bound only
+    # visits a few of them.
+    if profile is not None:
+        G = Weighted(G, profile)
+    n = G.number_of_nodes()
+    return csr_matrix(
+        (edge_weights(G, by), np.asarray(G.neighbors), np.asarray(G.offsets)),
+        shape=(n, n),
+    )
+
+
+def isochrone(G, sources, bound, by="cost"):
+    # The nodes within cost, or length, bound from the nearest source, and
+    # the edges of which both nodes are within the bound, with their
+    # distances; the distance of an edge is that of its nearest node.
+    t.tic()
+    graph, profile = (G.G, G.profile) if isinstance(G, Weighted) else (G, None)
+    if by == "length":
+        profile = None  # the lengths are the same for every profile
+    A = weight_matrix(graph, profile, by)
+    dist = dijkstra(
+        A, directed=True, indices=sources, limit=bound, min_only=True
+    )
+    nodes = np.flatnonzero(np.isfinite(dist))
+    # the edges of the nodes within the bound
+    starts = np.asarray(G.offsets[nodes])
+    lengths = np.asarray(G.offsets[nodes + 1]) - starts
+    shift = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+    edges = shift + np.arange(lengths.sum())
+    src = np.repeat(nodes, lengths)
+    dst = np.asarray(G.neighbors[edges])
+    # every edge is stored in both directions, keep one
+    keep = (src < dst) & np.isfinite(dist[dst])
+    edges, src, dst = edges[keep], src[keep], dst[keep]
+    edge_dist = np.minimum(dist[src], dist[dst])
+    print(f"{len(nodes)} nodes and {len(edges)} edges within {bound}")
+    t.toc()
+    return nodes, dist[nodes], edges, edge_dist
+
+
+def plot_isochrone(G, edges, name):
+    # Draw the edges in the colors of their tags, one polyline per color.
+    src = np.searchsorted(G.offsets, edges, side="right") - 1
+    dst = np.asarray(G.neighbors[edges])
+    coordinates = np.asarray(G.coordinates)
+    lines = np.stack([coordinates[src], coordinates[dst]], axis=1)
+    colors = np.array([common.tag_color[tag] for tag in G.tag[edges]])
+    mean_lat, mean_lon = coordinates[src].mean(axis=0)
+    myMap = folium.Map(location=[mean_lat, mean_lon], zoom_start=12)
+    for color in np.unique(colors):
+        folium.PolyLine(
+            lines[colors == color].tolist(),
+            color=color,
+            weight=2.5,
+            opacity=1,
+        ).add_to(myMap)
+    myMap.save(name + ".html")
+
+
+def main():
+    # All that lies within walking distance of the points of A_to_B.
+    from my_walks import A_to_B
+
+    db = DB()
+    path = Path(db, Coordinates(db), A_to_B)
+    path.get_graph_data()
+    sources = path.snap_waypoints()
+    _, _, edges, _ = isochrone(
+        path.G, sources, walking_distance, by="length"
+    )
+    plot_isochrone(path.G, edges, A_to_B.name + "_isochrone")
+    db.close_connection()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+from math import atan2, pi
+import numpy as np
+
+import common
+import geo
+from database import DB
+from find_path import Coordinates, Path
+from routing import Workspace
+
+from pytictoc import TicToc
+
+t = TicToc()
+
+# A loop from the start s is a walk s -> a -> b -> s along cheapest paths,
+# with via nodes a and b about a third of the target length away from s.
+# As via nodes we take, for each of a number of directions, the node of
+# the cheapest kilometers in that direction. Walking a part of a loop
+# twice is dull, so loops with a larger overlap are skipped, as are loops
+# that are much like a loop we already have.
+target_length = 15000
+directions = 16
+tolerance = 0.15  # the length of a loop may differ this much from the target
+max_overlap = 0.2  # the share of a loop that may be walked twice
+max_similarity = 0.6  # the share of edges that two loops may have in common
+
+
+def via_candidates(G, ws, source, order, target_length):
+    # Per direction, the node about a third of the target length away
+    # with the lowest cost per meter.
+    lat0, lon0 = float(G.latitude[source]), float(G.longitude[source])
+    best = {}
+    for v in order:
+        l = ws.length[v]
+        if not 0.25 * target_length <= l <= 0.4 * target_length:
+            continue
+        dy = float(G.latitude[v]) - lat0
+        dx = (float(G.longitude[v]) - lon0) * np.sqrt(geo.factor)
+        sector = int((atan2(dy, dx) + pi) / (2 * pi) * directions) % directions
+        score = ws.cost[v] / l
+        if sector not in best or score < best[sector][0]:
+            best[sector] = (score, v)
+    return [v for _, v in sorted(best.values())]
+
+
+def loop_stats(G, edges):
+    edges = np.array(edges, dtype=np.int64)
+    lengths = np.asarray(G.length[edges])
+    tags = np.asarray(G.tag[edges])
+    costs = np.array([G.edge_cost(e) for e in edges.tolist()])
+    length = lengths.sum()
+    # An edge and its reverse are stored at different positions; both
+    # count as the same edge when a loop walks it twice.
+    nodes = np.searchsorted(G.offsets, edges, side="right") - 1
+    key = np.minimum(nodes, G.neighbors[edges]) * G.number_of_nodes()
+    key += np.maximum(nodes, G.neighbors[edges])
+    _, first, counts = np.unique(key, return_index=True, return_counts=True)
+    twice = lengths[first][counts > 1].sum()
+    return {
+        "length": float(length),
+        "cost": float(costs.sum()),
+        "cost_per_km": float(1000 * costs.sum() / length),
+        "track_share": float(
+            lengths[tags == common.edge_tags["track"]].sum() / length
+        ),
+        "overlap": float(twice / length),
+        "edges": set(key.tolist()),
+    }
+
+
+def find_loops(G, source, target_length, k=5):
+    # The k best loops from source of about target_length meters, best
+    # first, by cost per kilometer and then by the share of tracks. Each
+    # loop is a list of nodes and a dict with its statistics. G may be a
+    # profile, see profiles.py.
+    t.tic()
+    ws = Workspace(G)
+    order = ws.search(source, 0.5 * target_length)
+    vias = via_candidates(G, ws, source, order, target_length)
+    out = {v: ws.edges_to(v) for v in vias}
+    length_out = {v: ws.length[v] for v in vias}
+
+    loops = []
+    for i, a in enumerate(vias):
+        others = vias[i + 1 :]
+        if not others:
+            break
+        ws.search(a, 0.5 * target_length, targets=others)
+        for b in others:
+            if not ws.settled[b]:
+                continue
+            length = length_out[a] + ws.length[b] + length_out[b]
+            if abs(length - target_length) > tolerance * target_length:
+                continue
+            # out to a, over to b, and back from b along the reversed path
+            back = [reverse_edge(G, e) for e in out[b][::-1]]
+            edges = out[a] + ws.edges_to(b) + back
+            stats = loop_stats(G, edges)
+            if stats["overlap"] <= max_overlap:
+                loops.append((edges, stats))
+    print(f"{len(vias)} via nodes, {len(loops)} candidate loops")
+
+    loops.sort(key=lambda l: (l[1]["cost_per_km"], -l[1]["track_share"]))
+    best = []
+    for edges, stats in loops:
+        if all(similarity(stats, s) <= max_similarity for _, s in best):
+            best.append((edges, stats))
+        if len(best) == k:
+            break
+    t.toc()
+    result = []
+    for edges, stats in best:
+        nodes = [source] + [int(G.neighbors[e]) for e in edges]
+        del stats["edges"]
+        result.append((nodes, stats))
+    return result
+
+
+def reverse_edge(G, e):
+    m = int(np.searchsorted(G.offsets, e, side="right")) - 1
+    return G.edge(int(G.neighbors[e]), m)
+
+
+def similarity(s1, s2):
+    common_edges = len(s1["edges"] & s2["edges"])
+    return common_edges / min(len(s1["edges"]), len(s2["edges"]))
+
+
+def main():
+    # Loops from the first point of A_to_B.
+    from my_walks import A_to_B
+
+    db = DB()
+    coordinates = Coordinates(db)
+    start = Path(db, coordinates, A_to_B)
+    start.get_graph_data()
+    source = start.snap_waypoints()[0]
+    loops = find_loops(start.G, source, target_length)
+    for i, (nodes, stats) in enumerate(loops):
+        print(
+            f"loop {i}: {int(stats['length'])} m, "
+            f"{stats['cost_per_km']:.0f} per km, "
+            f"{100 * stats['track_share']:.0f}% track"
+        )
+        path = Path(db, coordinates, A_to_B)
+        path.G = start.G
+        path.name = f"{A_to_B.name}_loop_{i}"
+        path.follow(nodes)
+        path.plot()
+        path.print_stats()
+        path.write_path_to_kml()
+    db.close_connection()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,346 @@
+#!/usr/bin/env python
+import argparse
+import hashlib
+from multiprocessing import Pool
+import os
+import shutil
+
+import buffers
+import ch
+import common
+import compress
+import database
+import geo
+import graph
+import port_info_to_database as ingest
+import profiles
+import proximity
+import routing
+import scenery
+import snap
+import storage
+import tiles
+from database import DB
+from graph import Graph
+
+from pytictoc import TicToc
+
+t = TicToc()
+
+# The import as a graph of stages. The hash of a stage covers all it depends
+# on: the hashes of the stages it comes after, the contents of the files it
+# reads, the settings of common it uses, and the source of the modules that
+# do the work. A stage is skipped when its hash equals the one stored in the
+# stages table when it last finished, and its outputs exist, unless a stage
+# it comes after runs again. Thus a new near_primary_cost only redoes the
+# costs and what follows, up to the graphs built from the snapshot, a new
+# extract of one province only reparses that province, and after a crash
+# the import resumes at the first stage that did not finish.
+
+
+class Stage:
+    # A stage runs as run(db, *args) in a bulk load of the database, so a
+    # stage that fails leaves the tables as they were. A parallel stage runs
+    # as run(*args) in a pool of processes, together with the other
+    # parallel stages that are out of date.
+    def __init__(
+        self,
+        name,
+        run,
+        args=(),
+        after=(),
+        files=(),
+        settings=(),
+        modules=(),
+        outputs=(),
+        parallel=False,
+    ):
+        self.name = name
+        self.run = run
+        self.args = args
+        self.after = after
+        self.files = files
+        self.settings = settings
+        self.modules = modules
+        self.outputs = outputs
+        self.parallel = parallel
+
+    def digest(self, hashes):
+        h = hashlib.sha256()
+        for name in self.after:
+            h.update(hashes[name].encode())
+        for fname in self.files:
+            h.update(file_digest(fname).encode())
+        for name in self.settings:
+            h.update(f"{name}={canonical(getattr(common, name))}".encode())
+        for module in self.modules:
+            h.update(file_digest(module.__file__).encode())
+        return h.hexdigest()
+
+    def has_outputs(self):
+        return all(os.path.exists(fname) for fname in self.outputs)
+
+
+def file_digest(fname):
+    h = hashlib.sha256()
+    with open(fname, "rb") as fp:
+        for block in iter(lambda: fp.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def canonical(value):
+    # Like repr, but independent of the order of sets and dicts, which may
+    # differ between runs.
+    if isinstance(value, dict):
+        items = sorted((canonical(k), canonical(v)) for k, v in value.items())
+        return "{" + ", ".join(f"{k}: {v}" for k, v in items) + "}"
+    if isinstance(value, (set, frozenset)):
+        return "{" + ", ".join(sorted(canonical(v) for v in value)) + "}"
+    if isinstance(value, (list, tuple)):
+        return "[" + ", ".join(canonical(v) for v in value) + "]"
+    return repr(value)
+
+
+def province_file(province):
+    return common.data_dir + province + ".npz"
+
+
+def merge(db):
+    # The edges of the largest component, and their nodes, in new tables.
+    db.rebuild()
+    ingest.merge_provinces(db, [province_file(p) for p in common.provinces])
+    db.make_indexes()
+
+
+def lengths(db):
+    ingest.compute_edge_length(db, where="1")
+
+
+def road_distances(db):
+    proximity.compute_road_distances(db)
+
+
+def scenic(db):
+    scenery.compute_scenic(db)
+
+
+def costs(db):
+    ingest.compute_edge_cost(db)
+
+
+def columns(db):
+    storage.export_columns(db)
+
+
+def snapshot(db):
+    # The graphs of the old snapshot no longer fit; those in common.graphs
+    # are built again by the stages after this one.
+    for directory in graph_dirs().values():
+        shutil.rmtree(directory, ignore_errors=True)
+    graph.build_snapshot(db)
+
+
+def snap_index(db):
+    snap.build_snap_index(Graph())
+
+
+def hierarchy(db):
+    ch.build_hierarchy(Graph())
+
+
+def compressed(db):
+    compress.compress(Graph())
+
+
+def tiled(db):
+    tiles.build_tiles(Graph())
+
+
+def graph_dirs():
+    return {
+        "hierarchy": common.ch_dir,
+        "compressed": common.compressed_dir,
+        "tiles": common.tiles_dir,
+    }
+
+
+def stages():
+    # In an order in which every stage comes after the stages it needs.
+    parse = [
+        Stage(
+            "parse_" + province,
+            ingest.parse_province,
+            args=(province,),
+            files=[common.data_dir + province + "-latest.osm.pbf"],
+            settings=["tags", "scenery", "scenery_spacing"],
+            modules=[ingest, scenery, buffers, geo],
+            outputs=[province_file(province)],
+            parallel=True,
+        )
+        for province in common.provinces
+    ]
+    tables = parse + [
+        Stage(
+            "merge",
+            merge,
+            after=[s.name for s in parse],
+            modules=[ingest, database],
+            outputs=[common.scenery_file],
+        ),
+        Stage("lengths", lengths, after=["merge"], modules=[ingest, geo]),
+        Stage(
+            "road_distances",
+            road_distances,
+            after=["merge"],
+            settings=[
+                "trunks",
+                "primary",
+                "secondary",
+                "near_trunk_distance",
+                "near_primary_distance",
+                "near_secondary_distance",
+            ],
+            modules=[proximity, geo],
+        ),
+        Stage(
+            "scenic",
+            scenic,
+            after=["merge"],
+            settings=[
+                "scenery",
+                "scenery_spacing",
+                "scenery_radius",
+                "scenery_weight",
+            ],
+            modules=[scenery, geo],
+        ),
+        Stage(
+            "costs",
+            costs,
+            after=["lengths", "road_distances", "scenic"],
+            settings=[
+                "trunks",
+                "cost_profiles",
+                "near_trunk_distance",
+                "near_primary_distance",
+                "near_secondary_distance",
+            ],
+            modules=[ingest, profiles],
+        ),
+    ]
+    # The snapshot reads the column storage when common.storage selects it.
+    export = []
+    if common.storage == "columns":
+        export = [
+            Stage(
+                "columns",
+                columns,
+                after=["costs"],
+                modules=[storage, geo],
+                outputs=[common.columns_dir],
+            )
+        ]
+    graphs = [
+        Stage(
+            "hierarchy",
+            hierarchy,
+            after=["snapshot"],
+            modules=[ch, routing],
+            outputs=[common.ch_dir],
+        ),
+        Stage(
+            "compressed",
+            compressed,
+            after=["snapshot"],
+            modules=[compress, routing],
+            outputs=[common.compressed_dir],
+        ),
+        Stage(
+            "tiles",
+            tiled,
+            after=["snapshot"],
+            modules=[tiles, compress, geo],
+            outputs=[common.tiles_dir],
+        ),
+    ]
+    return tables + export + [
+        Stage(
+            "snapshot",
+            snapshot,
+            after=[s.name for s in export] or ["costs"],
+            settings=["trunks", "storage"],
+            modules=[graph, storage],
+            outputs=[common.snapshot_dir],
+        ),
+        Stage(
+            "snap_index",
+            snap_index,
+            after=["snapshot"],
+            modules=[snap, geo],
+            outputs=[common.snap_dir],
+        ),
+    ] + [stage for stage in graphs if stage.name in common.graphs]
+
+
+def run_pipeline(db, force=()):
+    t.tic()
+    db.make_stage_table()
+    finished = db.get_stages()
+    hashes, todo = {}, []
+    for stage in stages():
+        hashes[stage.name] = stage.digest(hashes)
+        if (
+            stage.name in force
+            or finished.get(stage.name) != hashes[stage.name]
+            or not stage.has_outputs()
+            or any(name in todo for name in stage.after)
+        ):
+            todo.append(stage.name)
+        else:
+            print(f"{stage.name}: up to date")
+    # Should this run crash, the next one redoes all these stages.
+    db.forget_stages(todo)
+
+    todo = [stage for stage in stages() if stage.name in todo]
+    parallel = [stage for stage in todo if stage.parallel]
+    if parallel:
+        processes = min(len(parallel), os.cpu_count())
+        with Pool(processes) as pool:
+            results = []
+            for stage in parallel:
+                print(f"{stage.name}: running")
+                results.append(pool.apply_async(stage.run, stage.args))
+            for stage, result in zip(parallel, results):
+                result.get()
+                db.set_stage(stage.name, hashes[stage.name])
+    for stage in todo:
+        if stage.parallel:
+            continue
+        print(f"{stage.name}: running")
+        with db.bulk_load():
+            stage.run(db, *stage.args)
+        db.set_stage(stage.name, hashes[stage.name])
+    print(f"{len(todo)} stages run")
+    t.toc()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Import the provinces, skipping the stages up to date."
+    )
+    parser.add_argument(
+        "--force",
+        nargs="*",
+        default=[],
+        help="stages to run even when they are up to date",
+    )
+    args = parser.parse_args()
+
+    db = DB()
+    run_pipeline(db, force=args.force)
+    db.close_connection()
+
+
+if __name__ == '__main__':
+    main()
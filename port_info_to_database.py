@@ -1,215 +1,317 @@
 #!/usr/bin/env python
-from math import sqrt, cos, pi
 import numpy as np
-from sklearn.neighbors import KDTree
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
 import osmium
-import networkx as nx
 
 import common
+import geo
+from buffers import Buffer
 from database import DB
+from profiles import get_profile
+import scenery
 
 from pytictoc import TicToc
 
 t = TicToc()
 
 
+# Type of the index in which osmium keeps the node locations while reading
+# a file; see osmium.index.map_types(). The sparse types suit extracts of
+# provinces, the dense_mmap_array suits the whole country.
+location_index = "sparse_mem_array"
+
+
+# Number of rows per call to the database when writing edges and nodes.
+chunk_size = 1 << 20
+
+
 class Highway_Handler(osmium.SimpleHandler):
     # A highway is a sequence of nodes with a tag to indicate the type of highway.
+    # Osmium resolves the locations of the nodes of a way while it reads the
+    # file, so we get the coordinates of the highway nodes in the same pass.
+    # We store the edges and node locations in numpy buffers rather than
+    # python lists, to need just a few bytes per edge. The areas of the
+    # scenery come from the same pass.
     def __init__(self):
         osmium.SimpleHandler.__init__(self)
-        self.highways = []
+        self.node_from = Buffer(np.int64)
+        self.node_to = Buffer(np.int64)
+        self.tag = Buffer(np.uint8)
+        self.way_id = Buffer(np.int64)
+        self.node_id = Buffer(np.int64)
+        self.latitude = Buffer(np.float64)
+        self.longitude = Buffer(np.float64)
         self.tag_str_to_idx = {
             tag_str: i for i, tag_str in enumerate(common.tags)
         }
+        self.scenery = scenery.Scenery()
 
     def way(self, w):
-        tag = w.tags.get("highway")
-        if tag in self.tag_str_to_idx:
-            s = [w.nodes[i].ref for i in range(len(w.nodes))] + [
-                self.tag_str_to_idx[tag]
-            ]
-            self.highways.append(s)
-
-
-def read_write_highway_data(fname, db):
+        refs, lats, lons = [], [], []
+        for n in w.nodes:
+            if not n.location.valid():
+                return  # the extract misses a node of this highway
+            refs.append(n.ref)
+            lats.append(n.lat)
+            lons.append(n.lon)
+        tag = self.tag_str_to_idx[w.tags["highway"]]
+        self.node_from.extend(refs[:-1])
+        self.node_to.extend(refs[1:])
+        self.tag.extend([tag] * (len(refs) - 1))
+        self.way_id.extend([w.id] * (len(refs) - 1))
+        self.node_id.extend(refs)
+        self.latitude.extend(lats)
+        self.longitude.extend(lons)
+
+    def area(self, a):
+        self.scenery.area(a)
+
+    def apply(self, fname):
+        # Only the highways we know reach Python, osmium skips the rest.
+        highways = osmium.filter.TagFilter(
+            *[("highway", tag) for tag in common.tags]
+        ).enable_for(osmium.osm.WAY)
+        self.apply_file(
+            fname,
+            locations=True,
+            idx=location_index,
+            filters=[highways, self.scenery.filter()],
+        )
+
+
+def way_segments(node_from, node_to, way_id):
+    # Ways may share segments, pairs of nodes in either direction, such as
+    # a footway over a bridge that is a way of its own. The edge of a pair
+    # belongs to the way with the smallest id that has the pair; the other
+    # ways share it. For each segment, the index of the segment of its
+    # edge, and the masks of the segments that are an edge and of those
+    # that share one, without self loops and repeats in the same way.
+    low = np.minimum(node_from, node_to)
+    high = np.maximum(node_from, node_to)
+    order = np.lexsort((way_id, high, low))
+    low, high, way = low[order], high[order], way_id[order]
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = (low[1:] != low[:-1]) | (high[1:] != high[:-1])
+    repeat = np.zeros(len(order), dtype=bool)
+    repeat[1:] = ~first[1:] & (way[1:] == way[:-1])
+    owner = np.empty(len(order), dtype=np.int64)
+    owner[order] = order[first][np.cumsum(first) - 1]
+    edge = np.zeros(len(order), dtype=bool)
+    edge[order] = first & (low != high)
+    shared = np.zeros(len(order), dtype=bool)
+    shared[order] = ~first & ~repeat & (low != high)
+    return owner, edge, shared
+
+
+def largest_component(node_from, node_to):
+    # Mask of the edges in the largest connected component.
+    nodes, idx = np.unique(
+        np.concatenate([node_from, node_to]), return_inverse=True
+    )
+    m = len(node_from)
+    A = coo_matrix(
+        (np.ones(m, dtype=np.int8), (idx[:m], idx[m:])),
+        shape=(len(nodes), len(nodes)),
+    )
+    _, labels = connected_components(A, directed=False)
+    largest = np.argmax(np.bincount(labels))
+    return labels[idx[:m]] == largest
+
+
+def write_edges_and_nodes(
+    db, node_from, node_to, tag, way_id, node_id, lat, lon
+):
+    # The database only checks that the edges and nodes are unique at the
+    # end of a bulk load, so we check it before writing.
+    pairs = np.column_stack([node_from, node_to])
+    if len(np.unique(pairs, axis=0)) < len(pairs):
+        raise ValueError("Duplicate edges")
+    if len(np.unique(node_id)) < len(node_id):
+        raise ValueError("Duplicate nodes")
+    for i in range(0, len(node_from), chunk_size):
+        db.add_edges(
+            node_from[i : i + chunk_size].tolist(),
+            node_to[i : i + chunk_size].tolist(),
+            tag[i : i + chunk_size].tolist(),
+            way_id[i : i + chunk_size].tolist(),
+        )
+    for i in range(0, len(node_id), chunk_size):
+        db.add_nodes(
+            node_id[i : i + chunk_size].tolist(),
+            lat[i : i + chunk_size].tolist(),
+            lon[i : i + chunk_size].tolist(),
+        )
+
+
+def parse_province(province):
+    # Read the highways and the scenery of a province into an array file;
+    # this runs in a worker process.
     t.tic()
+    fname = common.data_dir + province + "-latest.osm.pbf"
     h = Highway_Handler()
-    h.apply_file(fname)
-    print("reading done")
+    h.apply(fname)
+    node_from, node_to = h.node_from.array(), h.node_to.array()
+    _, edge, shared = way_segments(node_from, node_to, h.way_id.array())
+    keep = edge | shared
+    node_id, first = np.unique(h.node_id.array(), return_index=True)
+    out = common.data_dir + province + ".npz"
+    np.savez(
+        out,
+        node_from=node_from[keep],
+        node_to=node_to[keep],
+        tag=h.tag.array()[keep],
+        way_id=h.way_id.array()[keep],
+        node_id=node_id,
+        latitude=h.latitude.array()[first],
+        longitude=h.longitude.array()[first],
+        **{"scenery_" + kind: p for kind, p in h.scenery.points().items()},
+    )
+    print(f"{fname} read")
     t.toc()
+    return out
+
+
+def merge_provinces(db, fnames):
+    # Provinces share the nodes and edges on their borders, so we remove
+    # duplicates after merging. Only then we look for the largest
+    # component, as some roads connect to the main network only via
+    # another province.
+    t.tic()
+    data = [np.load(fname) for fname in fnames]
+
+    def merged(name):
+        return np.concatenate([d[name] for d in data])
+
+    node_from, node_to = merged("node_from"), merged("node_to")
+    tag, way_id = merged("tag"), merged("way_id")
+    owner, edge, shared = way_segments(node_from, node_to, way_id)
+    # a shared segment goes in the direction of its edge
+    shared = {
+        "way_id": way_id[shared],
+        "node_from": node_from[owner[shared]],
+        "node_to": node_to[owner[shared]],
+        "tag": tag[shared],
+    }
+    node_from, node_to = node_from[edge], node_to[edge]
+    tag, way_id = tag[edge], way_id[edge]
 
     # Remove all highway nodes that are not connected
     # to the largest component of the highway graph
     # because such nodes can never appear in any sensible route.
-    G = nx.Graph()
-    for e in h.highways:
-        G.add_edges_from(zip(e[:-2], e[1:-1]), tag=e[-1])
-    largest = max(nx.connected_components(G), key=len)
-    G.remove_nodes_from(G.nodes() - largest)
+    keep = largest_component(node_from, node_to)
+    node_from, node_to = node_from[keep], node_to[keep]
+    tag, way_id = tag[keep], way_id[keep]
     print("largest component found")
     t.toc()
 
-    in_nodes, out_nodes, tags = [], [], []
-    for e in G.edges:
-        in_nodes.append(e[0])
-        out_nodes.append(e[1])
-        tags.append(G.get_edge_data(*e)['tag'])
-    db.add_edges(in_nodes, out_nodes, tags)
+    # We only need the coordinates of nodes that at either side of a highway edge.
+    node_id, first = np.unique(merged("node_id"), return_index=True)
+    keep = np.isin(node_id, node_from) | np.isin(node_id, node_to)
+    node_id, first = node_id[keep], first[keep]
+    write_edges_and_nodes(
+        db,
+        node_from,
+        node_to,
+        tag,
+        way_id,
+        node_id,
+        merged("latitude")[first],
+        merged("longitude")[first],
+    )
+    # the segments that share the edges that remain
+    keep = np.isin(shared["node_from"], node_from)
+    keep |= np.isin(shared["node_from"], node_to)
+    shared = [c[keep] for c in shared.values()]
+    for i in range(0, len(shared[0]), chunk_size):
+        db.add_shared_edges(*(c[i : i + chunk_size].tolist() for c in shared))
+    db.assign_node_indexes()
     print("writing done")
-    t.toc()
-
-
-class Node_Handler(osmium.SimpleHandler):
-    def __init__(self, highway_nodes):
-        osmium.SimpleHandler.__init__(self)
-        self.highway_nodes = highway_nodes
-        self.nodes = []
-
-    def node(self, n):
-        if n.id in self.highway_nodes:
-            self.nodes.append([n.id, n.location.lat, n.location.lon])
-
-
-def read_write_node_coordinates(fname, db):
-    # We only need the  coordinates of nodes that at either side of a highway edge.
-    t.tic()
-    highway_nodes = db.get_highway_nodes()
-    print("got nodes of edges")
-    t.toc()
 
-    nodes = Node_Handler(highway_nodes)
-    nodes.apply_file(fname)
-    ID, lon, lat = [], [], []
-    print("got node coordinates")
-    t.toc()
-
-    for n in nodes.nodes:
-        ID.append(n[0])
-        lat.append(n[1])
-        lon.append(n[2])
-
-    db.add_nodes(ID, lat, lon)
-    print("node coordinates to db")
+    points = {
+        kind: merged("scenery_" + kind)
+        for kind in scenery.kinds
+    }
+    np.savez(
+        common.scenery_file,
+        **{k: scenery.unique_points(p[:, 0], p[:, 1]) for k, p in points.items()},
+    )
     t.toc()
 
 
-def compute_edge_length(db):
-    C = pi / 180
-    R = 6378137  # earth radius is meters
-    CR = C * R
-    latitude_utrecht_domkerk = 52.09
-    factor = cos(latitude_utrecht_domkerk * pi / 180) ** 2
-
-    def haversine(lat1, lon1, lat2, lon2):
-        # good approximation for nearby points in the Netherlands
-        d2 = (lat1 - lat2) ** 2 + factor * (lon1 - lon2) ** 2
-        return sqrt(d2) * CR
-
+def compute_edge_length(db, where="length<=0"):
     t.tic()
-    edges = db.get_edge_info("id", "node_from", "node_to", where="length<=0")
-    if not edges:
+    edges = db.execute_array(
+        f"SELECT id, node_from, node_to FROM edges WHERE {where};",
+        [("id", np.int64), ("node_from", np.int64), ("node_to", np.int64)],
+    )
+    if len(edges) == 0:
         return
-    nodes = db.get_node_info("node_id", "latitude", "longitude")
-    node_info = {ID: (la, lo) for ID, la, lo in nodes}
-
-    ids, lengths = [], []
-    for e in edges:
-        ID, node_from, node_to = e
-        lat1, lon1 = node_info[node_from]
-        lat2, lon2 = node_info[node_to]
-        length = haversine(lat1, lon1, lat2, lon2)
-        ids.append(ID)
-        lengths.append(length)
-
-    sql = "UPDATE edges SET length=? WHERE ID=?"
-    db.update(sql, zip(lengths, ids))
+    nodes = db.execute_array(
+        "SELECT node_id, latitude, longitude FROM nodes;",
+        [("node_id", np.int64), ("lat", np.float64), ("lon", np.float64)],
+    )
+    nodes.sort(order="node_id")
+    start = node_rows(nodes, edges["node_from"])
+    end = node_rows(nodes, edges["node_to"])
+    found = (start >= 0) & (end >= 0)
+    if not found.all():
+        print(f"{np.sum(~found)} edges have a node without position, skipped")
+    edges, start, end = edges[found], nodes[start[found]], nodes[end[found]]
+    lengths = geo.distance(start["lat"], start["lon"], end["lat"], end["lon"])
+    db.update_columns("edges", edges["id"], length=lengths)
     t.toc()
 
 
-def set_tags_on_egdes(db, Type="trunk", tags={}, eps=0.005):
-    X = np.array(db.get_tagged_coordinates(tags))
-    tree = KDTree(X)
-    # Load the nodes and mark nodes near to a trunk
-    nodes = np.array(db.get_node_info("node_id", "latitude", "longitude"))
-    hit = tree.query_radius(nodes[:, [1, 2]], r=eps, count_only=True)
-    near_nodes = nodes[hit > 0][:, 0].astype(int)
-    ones = [1] * len(near_nodes)
-    sql = f"UPDATE edges SET near_{Type}=? WHERE node_from=?"
-    db.update(sql, zip(ones, near_nodes.tolist()))
-
-
-def tag_ugly_edges(db):
-    # Avoid walking in the neighborhood of trunks and primary highways
-    # eps = 0.005  is about 500 meters from a trunk
-    set_tags_on_egdes(db, "trunk", common.trunk_tags, eps=0.001)
+def node_rows(nodes, node_id):
+    # The rows of the nodes, sorted by node_id, with the node ids, and -1
+    # for the ids that are not in nodes.
+    k = np.searchsorted(nodes["node_id"], node_id)
+    found = k < len(nodes)
+    found[found] = nodes["node_id"][k[found]] == node_id[found]
+    return np.where(found, k, -1)
 
-    # stay clear about 20 meters from secondary
-    set_tags_on_egdes(db, "primary", common.primary_tags, eps=0.0002)
 
-
-def reset_tags_and_cost(db):
-    sql = f"UPDATE edges SET near_trunk=0, near_primary=0, cost=0"
-    db.execute(sql)
-    db.commit()
-
-
-def compute_edge_cost(db):
-    tag_to_idx = {tag_str: i for i, tag_str in enumerate(common.tags)}
-    factor = {
-        tag_to_idx[t]: common.cost_factor[t]
-        for t in tag_to_idx
-        if t not in common.trunks
-    }
+def compute_edge_cost(db, where="1"):
+    # The cost column holds the costs of the default profile.
+    profile = get_profile("default")
     trunk_tags = ",".join(str(t) for t in common.trunk_tags)
     sql = (
-        "SELECT id, tag, length, near_trunk, near_primary "
+        "SELECT id, tag, length, dist_trunk, dist_primary, dist_secondary, "
+        "scenic "
         "FROM edges "
-        f"WHERE tag NOT IN ({trunk_tags});"
+        f"WHERE tag NOT IN ({trunk_tags}) AND ({where});"
+    )
+    edges = db.execute_array(
+        sql,
+        [
+            ("id", np.int64),
+            ("tag", np.int64),
+            ("length", np.float64),
+            ("dist_trunk", np.float32),
+            ("dist_primary", np.float32),
+            ("dist_secondary", np.float32),
+            ("scenic", np.float32),
+        ],
+    )
+    costs = profile.weights(
+        edges["tag"],
+        edges["length"],
+        edges["dist_trunk"],
+        edges["dist_primary"],
+        edges["dist_secondary"],
+        edges["scenic"],
     )
-    IDs, costs = [], []
-    for e in db.execute(sql):
-        ID, tag, length, near_trunk, near_primary = e
-        cost = length * factor[tag]
-        if near_trunk:
-            cost *= common.near_trunk_cost
-        elif near_primary:
-            cost *= common.near_primary_cost
-        IDs.append(ID)
-        costs.append(cost)
-    sql = 'UPDATE edges SET cost=? WHERE id=?'
-    db.update(sql, zip(costs, IDs))
-
-
-def compute_cost(db):
-    reset_tags_and_cost(db)
-    tag_ugly_edges(db)
-    compute_edge_cost(db)
-
-
-def basic_setup(db):
-    for province in common.provinces:
-        fname = common.data_dir + province + "-latest.osm.pbf"
-        print(fname)
-        read_write_highway_data(fname, db)
-        read_write_node_coordinates(fname, db)
-    compute_edge_length(db)
+    db.update_columns("edges", edges["id"], cost=costs)
 
 
 def main():
-    db = DB()
-
-    build_new_database_p = False
-    build_new_database_p = True
-    if build_new_database_p:
-        db.rebuild()
-
-    fill_database_with_new_info_p = False
-    fill_database_with_new_info_p = True
-    if fill_database_with_new_info_p:
-        basic_setup(db)
-
-    compute_cost(db)
+    # The import runs as a pipeline that skips the stages that are up to
+    # date; pipeline.py imports this module, hence the late import.
+    from pipeline import run_pipeline
 
+    db = DB()
+    run_pipeline(db)
     db.close_connection()
 
 
@@ -0,0 +1,84 @@
+from functools import cache
+import numpy as np
+
+import common
+
+
+class Profile:
+    # The cost of an edge is its length times a factor that depends on the
+    # tag, found in a small table indexed by tag, times a penalty that
+    # decays with the distance to the nearest trunk, primary and secondary
+    # road, and times a discount for scenic edges; see common.py.
+    def __init__(
+        self,
+        cost_factor,
+        near_trunk_cost,
+        near_primary_cost,
+        near_secondary_cost=1,
+        scenic_discount=0,
+    ):
+        self.factor = np.array([cost_factor.get(t, np.inf) for t in common.tags])
+        self.near = [
+            (near_trunk_cost, common.near_trunk_distance),
+            (near_primary_cost, common.near_primary_distance),
+            (near_secondary_cost, common.near_secondary_distance),
+        ]
+        self.scenic_discount = scenic_discount
+
+    def penalty(self, dist_trunk, dist_primary, dist_secondary):
+        distances = [dist_trunk, dist_primary, dist_secondary]
+        return np.maximum.reduce(
+            [
+                1 + (cost - 1) * np.exp(-np.asarray(d, dtype=np.float64) / scale)
+                for (cost, scale), d in zip(self.near, distances)
+            ]
+        )
+
+    def weights(
+        self, tag, length, dist_trunk, dist_primary, dist_secondary, scenic
+    ):
+        penalty = self.penalty(dist_trunk, dist_primary, dist_secondary)
+        discount = 1 - self.scenic_discount * np.asarray(scenic, dtype=np.float64)
+        return length * self.factor[tag] * penalty * discount
+
+    def min_cost_factor(self):
+        near = min(1, *(cost for cost, _ in self.near))
+        return self.factor.min() * near * (1 - self.scenic_discount)
+
+
+@cache
+def get_profile(name):
+    return Profile(**common.cost_profiles[name])
+
+
+class Weighted:
+    # The graph G with the edge costs of a profile instead of the cost
+    # column. The costs are computed when needed, so any number of
+    # profiles can share the arrays of G.
+    def __init__(self, G, profile):
+        self.G = G
+        self.profile = get_profile(profile) if isinstance(profile, str) else profile
+
+    def __getattr__(self, name):
+        return getattr(self.G, name)
+
+    def edge_weights(self, edges):
+        G = self.G
+        return self.profile.weights(
+            G.tag[edges],
+            G.length[edges],
+            G.dist_trunk[edges],
+            G.dist_primary[edges],
+            G.dist_secondary[edges],
+            G.scenic[edges],
+        )
+
+    def edge_cost(self, e):
+        return float(self.edge_weights(e))
+
+    def adjacent(self, i):
+        start, stop = self.G.offsets[i], self.G.offsets[i + 1]
+        return self.G.neighbors[start:stop], self.edge_weights(slice(start, stop))
+
+    def min_cost_factor(self):
+        return self.profile.min_cost_factor()
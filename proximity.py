@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+from concurrent.futures import ProcessPoolExecutor
+import os
+import numpy as np
+from scipy.spatial import cKDTree
+
+import common
+import geo
+from database import DB
+
+from pytictoc import TicToc
+
+t = TicToc()
+
+# The distance from the midpoint of every edge to the nearest trunk, primary
+# and secondary road, in meters. The roads are sampled every spacing meters,
+# so a distance is at most spacing / 2 too large. The edges are handled in
+# chunks of chunk_size by a pool of processes; at most max_pending chunks
+# are in flight, so the memory use does not grow with the number of edges.
+road_classes = {
+    "trunk": common.trunk_tags,
+    "primary": common.primary_tags,
+    "secondary": common.secondary_tags,
+}
+spacing = 10.0
+chunk_size = 1 << 18
+max_pending = 2 * os.cpu_count()
+far = 1e6  # the distance when there is no road of a class at all
+
+endpoints_sql = (
+    "SELECT edges.id, a.latitude, a.longitude, b.latitude, b.longitude "
+    "FROM edges "
+    "JOIN nodes AS a ON a.node_id = edges.node_from "
+    "JOIN nodes AS b ON b.node_id = edges.node_to "
+)
+endpoints_dtype = [
+    ("id", np.int64),
+    ("lat_from", np.float64),
+    ("lon_from", np.float64),
+    ("lat_to", np.float64),
+    ("lon_to", np.float64),
+]
+
+
+def road_points(db, tags):
+    # Points every spacing meters along the edges with one of the tags,
+    # in projected coordinates.
+    Tags = ",".join(str(t) for t in tags)
+    edges = db.execute_array(
+        endpoints_sql + f"WHERE tag IN ({Tags});", endpoints_dtype
+    )
+    x0, y0 = geo.project(edges["lat_from"], edges["lon_from"])
+    x1, y1 = geo.project(edges["lat_to"], edges["lon_to"])
+    steps = np.maximum(np.ceil(np.hypot(x1 - x0, y1 - y0) / spacing), 1)
+    steps = steps.astype(np.int64)
+    edge = np.repeat(np.arange(len(edges)), steps + 1)
+    first = np.repeat(np.cumsum(steps + 1) - steps - 1, steps + 1)
+    fraction = (np.arange(len(edge)) - first) / steps[edge]
+    x = x0[edge] + fraction * (x1 - x0)[edge]
+    y = y0[edge] + fraction * (y1 - y0)[edge]
+    return np.column_stack([x, y])
+
+
+trees = {}
+
+
+def init_worker(points):
+    # Each worker builds its own trees once, and uses them for all chunks.
+    for name, p in points.items():
+        trees[name] = cKDTree(p) if len(p) > 0 else None
+
+
+def nearest_roads(ids, x, y):
+    midpoints = np.column_stack([x, y])
+    distances = {}
+    for name, tree in trees.items():
+        if tree is None:
+            d = np.full(len(ids), far)
+        else:
+            d, _ = tree.query(midpoints, k=1, distance_upper_bound=far)
+        distances["dist_" + name] = np.minimum(d, far).astype(np.float32)
+    return ids, distances
+
+
+def edge_chunks(db, where="1"):
+    # Read the edges in chunks, continuing after the largest id of the
+    # previous chunk, so that no chunk needs an OFFSET scan.
+    last = -1
+    while True:
+        edges = db.execute_array(
+            endpoints_sql
+            + f"WHERE edges.id > {last} AND ({where}) "
+            + f"ORDER BY edges.id LIMIT {chunk_size};",
+            endpoints_dtype,
+        )
+        if len(edges) == 0:
+            return
+        last = edges["id"][-1]
+        x0, y0 = geo.project(edges["lat_from"], edges["lon_from"])
+        x1, y1 = geo.project(edges["lat_to"], edges["lon_to"])
+        yield edges["id"], (x0 + x1) / 2, (y0 + y1) / 2
+
+
+def store(db, ids, distances):
+    db.update_columns(
+        "edges",
+        ids,
+        **distances,
+        near_trunk=distances["dist_trunk"] < common.near_trunk_distance,
+        near_primary=distances["dist_primary"] < common.near_primary_distance,
+    )
+
+
+def compute_road_distances(db, where="1"):
+    # where selects the edges to compute the distances for.
+    t.tic()
+    points = {name: road_points(db, tags) for name, tags in road_classes.items()}
+    print(
+        "road points: "
+        + ", ".join(f"{name} {len(p)}" for name, p in points.items())
+    )
+    with ProcessPoolExecutor(
+        initializer=init_worker, initargs=(points,)
+    ) as executor:
+        pending = []
+        for ids, x, y in edge_chunks(db, where):
+            pending.append(executor.submit(nearest_roads, ids, x, y))
+            if len(pending) >= max_pending:
+                store(db, *pending.pop(0).result())
+        for future in pending:
+            store(db, *future.result())
+    print("distances to roads done")
+    t.toc()
+
+
+def main():
+    db = DB()
+    compute_road_distances(db)
+    db.close_connection()
+
+
+if __name__ == '__main__':
+    main()
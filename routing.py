@@ -0,0 +1,224 @@
+import heapq
+from math import inf
+import numpy as np
+
+import geo
+
+
+class NoPath(Exception):
+    pass
+
+
+def unwind(pred, node):
+    # Follow the predecessors back to the source.
+    path = []
+    while node != -1:
+        path.append(node)
+        node = pred[node]
+    return path[::-1]
+
+
+def dijkstra(G, source, target):
+    # Cheapest path from source to target, source and target are node
+    # numbers of the csr graph G. Return the path and the number of
+    # settled nodes.
+    dist = {source: 0.0}
+    pred = {source: -1}
+    settled = set()
+    heap = [(0.0, source)]
+    while heap:
+        d, u = heapq.heappop(heap)
+        if u in settled:
+            continue
+        settled.add(u)
+        if u == target:
+            return unwind(pred, target), len(settled)
+        nbrs, costs = G.adjacent(u)
+        for v, c in zip(nbrs.tolist(), costs.tolist()):
+            if d + c < dist.get(v, inf):
+                dist[v] = d + c
+                pred[v] = u
+                heapq.heappush(heap, (d + c, v))
+    raise NoPath(f"No path from {source} to {target}")
+
+
+def bidirectional_astar(G, source, target, scale=None):
+    # Search from source and from target at the same time.  Both searches
+    # use the potential p(v) = (h_t(v) - h_s(v)) / 2, with h_s and h_t the
+    # estimated cost from source to v and v to target.  With this p the
+    # forward search uses key d(v) + p(v), the backward search
+    # d(v) - p(v), and both searches see the same non-negative reduced
+    # costs. We may stop once the two smallest keys add up to the cost
+    # of the best path found so far.
+    # The cost of an edge is at least its length times the smallest cost
+    # factor, so this times the distance as the crow flies is a lower
+    # bound on the cost.
+    if scale is None:
+        scale = G.min_cost_factor()
+    if source == target:
+        return [source], 0
+    lat_s, lon_s = float(G.latitude[source]), float(G.longitude[source])
+    lat_t, lon_t = float(G.latitude[target]), float(G.longitude[target])
+    potentials = {}
+
+    def potential(v):
+        if v not in potentials:
+            lat, lon = float(G.latitude[v]), float(G.longitude[v])
+            h_t = geo.distance(lat, lon, lat_t, lon_t)
+            h_s = geo.distance(lat, lon, lat_s, lon_s)
+            potentials[v] = float(scale * (h_t - h_s) / 2)
+        return potentials[v]
+
+    sign = [1, -1]  # forward, backward
+    dist = [{source: 0.0}, {target: 0.0}]
+    pred = [{source: -1}, {target: -1}]
+    settled = [set(), set()]
+    heaps = [[(potential(source), source)], [(-potential(target), target)]]
+    best, meet = inf, -1
+    while heaps[0] and heaps[1]:
+        if heaps[0][0][0] + heaps[1][0][0] >= best:
+            break
+        side = 0 if len(heaps[0]) <= len(heaps[1]) else 1
+        _, u = heapq.heappop(heaps[side])
+        if u in settled[side]:
+            continue
+        settled[side].add(u)
+        d = dist[side][u]
+        other = dist[1 - side]
+        nbrs, costs = G.adjacent(u)
+        for v, c in zip(nbrs.tolist(), costs.tolist()):
+            if d + c < dist[side].get(v, inf):
+                dist[side][v] = d + c
+                pred[side][v] = u
+                key = d + c + sign[side] * potential(v)
+                heapq.heappush(heaps[side], (key, v))
+                if v in other and d + c + other[v] < best:
+                    best, meet = d + c + other[v], v
+    if meet == -1:
+        raise NoPath(f"No path from {source} to {target}")
+    path = unwind(pred[0], meet) + unwind(pred[1], meet)[-2::-1]
+    return path, len(settled[0]) + len(settled[1])
+
+
+class Workspace:
+    # The arrays of a search from a single node, with an entry per node of
+    # G. They are allocated once and reused for every search; a search
+    # only resets the entries that the previous search touched.
+    def __init__(self, G):
+        n = G.number_of_nodes()
+        self.G = G
+        self.cost = [inf] * n
+        self.length = [0.0] * n
+        self.parent = [-1] * n
+        self.pred = [-1] * n  # the position of the edge from the parent
+        self.settled = [False] * n
+        self.touched = []
+        self.heap = []
+
+    def reset(self):
+        for v in self.touched:
+            self.cost[v] = inf
+            self.length[v] = 0.0
+            self.parent[v] = -1
+            self.pred[v] = -1
+            self.settled[v] = False
+        self.touched = []
+        self.heap = []
+
+    def search(self, source, max_length=inf, targets=(), max_cost=inf):
+        # Dijkstra from source that does not go beyond paths of max_length
+        # meters or max_cost, and stops early once all targets are settled.
+        # Returns the settled nodes in order of cost.
+        self.reset()
+        self.cost[source] = 0.0
+        self.touched.append(source)
+        self.heap = [(0.0, source)]
+        return self.resume(max_length, targets, max_cost)
+
+    def resume(self, max_length=inf, targets=(), max_cost=inf):
+        # Continue the last search up to new limits, without settling its
+        # nodes again. Returns the nodes settled in this part.
+        G = self.G
+        cost, length, settled = self.cost, self.length, self.settled
+        parent, pred = self.parent, self.pred
+        todo = {v for v in targets if not settled[v]}
+        if targets and not todo:
+            return []
+        order = []
+        heap = self.heap
+        while heap:
+            if heap[0][0] > max_cost:
+                break
+            d, u = heapq.heappop(heap)
+            if settled[u]:
+                continue
+            settled[u] = True
+            order.append(u)
+            todo.discard(u)
+            if length[u] <= max_length:
+                start = int(G.offsets[u])
+                nbrs, costs = G.adjacent(u)
+                lengths = G.length[start : start + len(nbrs)]
+                for k, (v, c, l) in enumerate(
+                    zip(nbrs.tolist(), costs.tolist(), lengths.tolist())
+                ):
+                    if d + c < cost[v]:
+                        if cost[v] == inf:
+                            self.touched.append(v)
+                        cost[v] = d + c
+                        length[v] = length[u] + l
+                        parent[v] = u
+                        pred[v] = start + k
+                        heapq.heappush(heap, (d + c, v))
+            if targets and not todo:
+                break
+        return order
+
+    def edges_to(self, node):
+        # The positions of the edges of the path from the source to node.
+        edges = []
+        while self.parent[node] != -1:
+            edges.append(self.pred[node])
+            node = self.parent[node]
+        return edges[::-1]
+
+    def nodes_to(self, node):
+        # The nodes of the path from the source to node.
+        return unwind(self.parent, node)
+
+
+def one_to_many(G, source, targets):
+    # Costs of the cheapest paths from source to each of the targets, in a
+    # single Dijkstra search that stops when all targets are settled.
+    # Unreachable targets get cost inf.
+    todo = {}
+    for j, v in enumerate(targets):
+        todo.setdefault(v, []).append(j)
+    costs = np.full(len(targets), inf)
+    dist = {source: 0.0}
+    settled = set()
+    heap = [(0.0, source)]
+    while heap and todo:
+        d, u = heapq.heappop(heap)
+        if u in settled:
+            continue
+        settled.add(u)
+        for j in todo.pop(u, []):
+            costs[j] = d
+        nbrs, cs = G.adjacent(u)
+        for v, c in zip(nbrs.tolist(), cs.tolist()):
+            if d + c < dist.get(v, inf):
+                dist[v] = d + c
+                heapq.heappush(heap, (d + c, v))
+    return costs
+
+
+def cost_matrix(G, sources, targets):
+    # One search per source fills a whole row.
+    return np.array([one_to_many(G, s, targets) for s in sources])
+
+
+routers = {
+    "dijkstra": dijkstra,
+    "astar": bidirectional_astar,
+}
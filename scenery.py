@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+from concurrent.futures import ProcessPoolExecutor
+import os
+import numpy as np
+from scipy.spatial import cKDTree
+import osmium
+
+import common
+import geo
+from buffers import Buffer
+from database import DB
+
+from pytictoc import TicToc
+
+t = TicToc()
+
+# The forests, heaths, water and farmland of common.scenery, as the points
+# of a lattice with common.scenery_spacing meters between the points that
+# lie inside such an area. Since all areas use the same lattice, the points
+# of overlapping areas coincide and we can remove the duplicates.
+kinds = sorted(set(common.scenery.values()))
+chunk_size = 1 << 18
+max_pending = 2 * os.cpu_count()
+
+
+def first_row(v):
+    # The smallest k with k * spacing >= v, for an array v, exact also
+    # where v / spacing rounds.
+    s = common.scenery_spacing
+    k = np.ceil(v / s)
+    k -= (k - 1) * s >= v
+    k += k * s < v
+    return k.astype(np.int64)
+
+
+def lattice_inside(rings):
+    # The lattice points inside the rings of an area, as rows of i, j with
+    # i * spacing, j * spacing the projected coordinates of the point. We
+    # fill the area row by row: a row j crosses the edges of the rings
+    # that start at or below j * spacing and end above it, or the other way
+    # round, and a point of the row is inside when an odd number of these
+    # crossings lie on its right, which also takes care of the holes of
+    # the area. Sorted, the crossings of a row thus pair up into the
+    # stretches that are inside. The work grows with the edges times the
+    # rows they cross plus the points inside, rather than with the edges
+    # times all the points of the bounding box.
+    s = common.scenery_spacing
+    x1 = np.concatenate([r[0][:-1] for r in rings])
+    y1 = np.concatenate([r[1][:-1] for r in rings])
+    x2 = np.concatenate([r[0][1:] for r in rings])
+    y2 = np.concatenate([r[1][1:] for r in rings])
+    low = first_row(np.minimum(y1, y2))
+    high = first_row(np.maximum(y1, y2))
+    rows = high - low
+    crossing = rows > 0
+    x1, y1, x2, y2 = x1[crossing], y1[crossing], x2[crossing], y2[crossing]
+    low, rows = low[crossing], rows[crossing]
+    if len(rows) == 0:
+        return np.empty((0, 2), dtype=np.int64)
+    edge = np.repeat(np.arange(len(rows)), rows)
+    start = np.cumsum(rows) - rows
+    j = low[edge] + np.arange(len(edge)) - start[edge]
+    py = j * s
+    x1, y1, x2, y2 = x1[edge], y1[edge], x2[edge], y2[edge]
+    x = x1 + (x2 - x1) * (py - y1) / (y2 - y1)
+    order = np.lexsort((x, j))
+    j, x = j[order], x[order]
+    # the place of each crossing in its row
+    new_row = np.ones(len(j), dtype=bool)
+    new_row[1:] = j[1:] != j[:-1]
+    k = np.arange(len(j))
+    place = k - np.maximum.accumulate(np.where(new_row, k, 0))
+    left = np.flatnonzero(place % 2 == 0)
+    left = left[left + 1 < len(j)]
+    left = left[j[left + 1] == j[left]]
+    # the points with x[left] <= i * spacing < x[left + 1]
+    first, last = first_row(x[left]), first_row(x[left + 1])
+    count = np.maximum(last - first, 0)
+    row = np.repeat(j[left], count)
+    stretch = np.cumsum(count) - count
+    i = np.repeat(first - stretch, count) + np.arange(len(row))
+    return np.column_stack([i, row]).astype(np.int64)
+
+
+class Scenery:
+    # Collects the lattice points of the areas that osmium assembles from
+    # closed ways and multipolygon relations. The handler that reads the
+    # highways of a province hands it the areas, so that the file is read
+    # in a single pass; osmium only reads the relations once before, to
+    # know the ways of the multipolygons.
+    def __init__(self):
+        self.i = {kind: Buffer(np.int64) for kind in kinds}
+        self.j = {kind: Buffer(np.int64) for kind in kinds}
+
+    def area(self, a):
+        kind = None
+        for key, value in common.scenery:
+            if a.tags.get(key) == value:
+                kind = common.scenery[key, value]
+        if kind is None:
+            return
+        rings = []
+        try:
+            for outer in a.outer_rings():
+                rings.append(self.ring(outer))
+                for inner in a.inner_rings(outer):
+                    rings.append(self.ring(inner))
+        except osmium.InvalidLocationError:
+            return  # the extract misses a node of this area
+        if not rings:
+            return
+        points = lattice_inside(rings)
+        self.i[kind].extend(points[:, 0])
+        self.j[kind].extend(points[:, 1])
+
+    @staticmethod
+    def ring(nodes):
+        lat = np.array([n.lat for n in nodes])
+        lon = np.array([n.lon for n in nodes])
+        return geo.project(lat, lon)
+
+    @staticmethod
+    def filter():
+        # Only the relations and areas with a key of common.scenery reach
+        # Python; the ways pass, as the highways need them.
+        keys = set(key for key, _ in common.scenery)
+        return osmium.filter.KeyFilter(*keys).enable_for(
+            osmium.osm.RELATION | osmium.osm.AREA
+        )
+
+    def points(self):
+        # The lattice points per kind, without duplicates.
+        return {
+            kind: unique_points(self.i[kind].array(), self.j[kind].array())
+            for kind in kinds
+        }
+
+
+def unique_points(i, j):
+    if len(i) == 0:
+        return np.empty((0, 2), dtype=np.int64)
+    return np.unique(np.column_stack([i, j]), axis=0)
+
+
+def disc_size():
+    # The number of lattice points within scenery_radius of a lattice point.
+    r = int(common.scenery_radius // common.scenery_spacing)
+    i, j = np.meshgrid(np.arange(-r, r + 1), np.arange(-r, r + 1))
+    s = common.scenery_spacing
+    return int(((i * s) ** 2 + (j * s) ** 2 <= common.scenery_radius**2).sum())
+
+
+trees = {}
+
+
+def init_worker(points):
+    for kind, p in points.items():
+        if len(p) > 0:
+            trees[kind] = cKDTree(p * common.scenery_spacing)
+        else:
+            trees[kind] = None
+
+
+def node_scores(idx, x, y):
+    # The weighted share of scenery around each node.
+    nodes = np.column_stack([x, y])
+    score = np.zeros(len(idx))
+    size = disc_size()
+    for kind, tree in trees.items():
+        if tree is None:
+            continue
+        count = tree.query_ball_point(
+            nodes, r=common.scenery_radius, return_length=True
+        )
+        score += common.scenery_weight[kind] * np.minimum(count / size, 1)
+    return idx, np.minimum(score, 1)
+
+
+def node_chunks(db, where="1"):
+    last = -1
+    while True:
+        nodes = db.execute_array(
+            "SELECT id, idx, latitude, longitude FROM nodes "
+            f"WHERE id > {last} AND ({where}) "
+            f"ORDER BY id LIMIT {chunk_size};",
+            [
+                ("id", np.int64),
+                ("idx", np.int64),
+                ("latitude", np.float64),
+                ("longitude", np.float64),
+            ],
+        )
+        if len(nodes) == 0:
+            return
+        last = nodes["id"][-1]
+        x, y = geo.project(nodes["latitude"], nodes["longitude"])
+        yield nodes["idx"], x, y
+
+
+def compute_scenic(db, fname=common.scenery_file, where="1"):
+    # Score the nodes on a pool of processes, chunk by chunk, and give each
+    # edge the mean score of its nodes. where selects the edges to score,
+    # and so the nodes.
+    t.tic()
+    if not os.path.exists(fname):
+        print(f"{fname} not found, no scenic scores")
+        return
+    with np.load(fname) as data:
+        points = {kind: data[kind] for kind in kinds}
+    print(
+        "scenery points: "
+        + ", ".join(f"{kind} {len(p)}" for kind, p in points.items())
+    )
+    num_nodes = db.execute("SELECT MAX(idx) FROM nodes;")[0][0] + 1
+    scores = np.zeros(num_nodes, dtype=np.float32)
+    node_where = "1"
+    if where != "1":
+        node_where = (
+            f"node_id IN (SELECT node_from FROM edges WHERE {where}) "
+            f"OR node_id IN (SELECT node_to FROM edges WHERE {where})"
+        )
+    with ProcessPoolExecutor(
+        initializer=init_worker, initargs=(points,)
+    ) as executor:
+        pending = []
+        for idx, x, y in node_chunks(db, node_where):
+            pending.append(executor.submit(node_scores, idx, x, y))
+            if len(pending) >= max_pending:
+                idx, score = pending.pop(0).result()
+                scores[idx] = score
+        for future in pending:
+            idx, score = future.result()
+            scores[idx] = score
+
+    edges = db.execute_array(
+        "SELECT edges.id, a.idx, b.idx FROM edges "
+        "JOIN nodes AS a ON a.node_id = edges.node_from "
+        "JOIN nodes AS b ON b.node_id = edges.node_to "
+        f"WHERE {where};",
+        [("id", np.int64), ("idx_from", np.int64), ("idx_to", np.int64)],
+    )
+    scenic = (scores[edges["idx_from"]] + scores[edges["idx_to"]]) / 2
+    db.update_columns("edges", edges["id"], scenic=scenic)
+    print("scenic scores done")
+    t.toc()
+
+
+def main():
+    db = DB()
+    compute_scenic(db)
+    db.close_connection()
+
+
+if __name__ == '__main__':
+    main()
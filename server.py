@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+import argparse
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+import queue
+from types import SimpleNamespace
+from urllib.parse import parse_qs, urlparse
+import numpy as np
+
+import common
+import find_path
+import geo
+from database import DB
+from find_path import Coordinates, Path
+from profiles import get_profile
+from routing import NoPath
+
+# A local routing service. The graph, the hierarchy, the snap index and the
+# profiles are loaded once, when the server starts, and every request is
+# answered by a thread of its own. The arrays are only read, so the
+# threads share them; the database connections, which are only needed to
+# snap without snap index, come from a pool.
+#
+#   /route?points=52.09,5.12;52.05,5.18&format=geojson
+#   /stats?points=52.09,5.12;52.05,5.18&profile=forest-lover
+#   /snap?points=52.09,5.12&tags=track,path
+#
+# /route and /stats also take method, profile, reorder and round_trip, see
+# Path; the format of a route is geojson, kml or gpx.
+content_types = {
+    "geojson": "application/geo+json",
+    "kml": "application/vnd.google-earth.kml+xml",
+    "gpx": "application/gpx+xml",
+    "json": "application/json",
+}
+
+
+class Connections:
+    # A pool of read only database connections, each with its coordinates.
+    def __init__(self, size):
+        self.pool = queue.Queue()
+        for _ in range(size):
+            db = DB(read_only=True)
+            self.pool.put((db, Coordinates(db)))
+
+    @contextmanager
+    def get(self):
+        item = self.pool.get()
+        try:
+            yield item
+        finally:
+            self.pool.put(item)
+
+    def close(self):
+        while not self.pool.empty():
+            db, _ = self.pool.get()
+            db.close_connection()
+
+
+def parse_points(query):
+    # "lat,lon;lat,lon" to [(lat, lon), (lat, lon)]
+    points = [
+        tuple(float(x) for x in p.split(","))
+        for p in query["points"].split(";")
+        if p
+    ]
+    if not points or any(len(p) != 2 for p in points):
+        raise ValueError("points should be lat,lon;lat,lon;...")
+    return points
+
+
+def flag(query, name):
+    return query.get(name, "").lower() in ("1", "true", "yes")
+
+
+def compute_path(server, query):
+    walk = SimpleNamespace(
+        name=query.get("name", "route"),
+        coordinates=parse_points(query),
+        node_ids=[],
+    )
+    if len(walk.coordinates) < 2:
+        raise ValueError("a route needs at least two points")
+    # the hierarchy knows only the costs of the default profile
+    method = server.method if "profile" not in query else "astar"
+    with server.connections.get() as (db, coordinates):
+        path = Path(
+            db,
+            coordinates,
+            walk,
+            method=query.get("method", method),
+            profile=query.get("profile"),
+            reorder=flag(query, "reorder"),
+            round_trip=flag(query, "round_trip"),
+        )
+        path.compute_shortest_path()
+    return path
+
+
+def route(server, query):
+    path = compute_path(server, query)
+    fmt = query.get("format", "geojson")
+    if fmt == "geojson":
+        return fmt, json.dumps(path.geojson())
+    if fmt == "kml":
+        return fmt, path.kml().kml()
+    if fmt == "gpx":
+        return fmt, path.gpx().to_xml()
+    raise ValueError(f"Unknown format {fmt}")
+
+
+def stats(server, query):
+    return "json", json.dumps(compute_path(server, query).stats())
+
+
+def snap(server, query):
+    points = parse_points(query)
+    tags = query["tags"].split(",") if "tags" in query else None
+    if tags and any(t not in common.edge_tags for t in tags):
+        raise ValueError(f"Unknown tag in {tags}")
+    G = find_path.load_graph()
+    if os.path.exists(common.snap_dir):
+        nodes, distances = find_path.load_snap_index().nearest(points, tags)
+    else:
+        if tags:
+            raise ValueError("snapping to tags needs the snap index")
+        with server.connections.get() as (db, coordinates):
+            nodes = [coordinates.find_node_nearby_gps(p) for p in points]
+        nodes, (lat, lon) = np.array(nodes), np.array(points).T
+        distances = geo.distance(
+            lat, lon, G.latitude[nodes], G.longitude[nodes]
+        )
+    # A point too far from the graph has no node.
+    result = [
+        {
+            "node": int(n),
+            "node_id": int(G.node_ids[n]),
+            "latitude": float(G.latitude[n]),
+            "longitude": float(G.longitude[n]),
+            "distance": float(d),
+        }
+        if n >= 0
+        else None
+        for n, d in zip(nodes.tolist(), distances.tolist())
+    ]
+    return "json", json.dumps(result)
+
+
+class Routing_Handler(BaseHTTPRequestHandler):
+    requests = {"/route": route, "/stats": stats, "/snap": snap}
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        if url.path not in self.requests:
+            return self.reply(404, "json", json.dumps({"error": "not found"}))
+        try:
+            fmt, body = self.requests[url.path](self.server, query)
+        except NoPath as e:
+            return self.reply(404, "json", json.dumps({"error": str(e)}))
+        except (KeyError, ValueError) as e:
+            return self.reply(400, "json", json.dumps({"error": str(e)}))
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+            return self.reply(500, "json", json.dumps({"error": error}))
+        self.reply(200, fmt, body)
+
+    def reply(self, status, fmt, body):
+        body = body.encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_types[fmt])
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def make_server(host="127.0.0.1", port=0, connections=4):
+    # With port 0 the system picks a free port, see server.server_address.
+    # Everything is loaded into memory before the first request.
+    find_path.mmap_mode = None
+    find_path.load_graph()
+    if os.path.exists(common.ch_dir):
+        find_path.load_hierarchy()
+    if os.path.exists(common.snap_dir):
+        find_path.load_snap_index()
+    for name in common.cost_profiles:
+        get_profile(name)
+    server = ThreadingHTTPServer((host, port), Routing_Handler)
+    server.daemon_threads = True
+    server.connections = Connections(connections)
+    server.method = "ch" if os.path.exists(common.ch_dir) else "astar"
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local routing service.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--connections", type=int, default=4)
+    args = parser.parse_args()
+
+    server = make_server(args.host, args.port, args.connections)
+    print(f"serving on http://{args.host}:{server.server_address[1]}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.connections.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+import os
+import numpy as np
+
+import common
+import geo
+from graph import Graph
+
+from pytictoc import TicToc
+
+t = TicToc()
+
+
+class SnapIndex:
+    # A grid over the metric coordinates of the snapshot nodes, to find
+    # the routable node nearest to a gps point. The nodes are sorted by
+    # cell; the nodes in cells[k] are nodes[cell_offsets[k]:cell_offsets[k + 1]].
+    # x and y are relative to the origin of the grid, and tag_mask has bit
+    # t set when the node lies on an edge with tag t.
+    arrays = ["grid", "cells", "cell_offsets", "nodes", "x", "y", "tag_mask"]
+
+    def __init__(self, directory=common.snap_dir, mmap_mode="r"):
+        for name in self.arrays:
+            fname = os.path.join(directory, name + ".npy")
+            setattr(self, name, np.load(fname, mmap_mode=mmap_mode))
+        self.x0, self.y0, self.cell_size = self.grid[:3]
+        self.columns, self.rows = int(self.grid[3]), int(self.grid[4])
+
+    def candidates(self, cx, cy):
+        # For each cell cx, cy, the positions of its nodes in self.nodes,
+        # and for each of these the index of the cell in cx and cy.
+        inside = (cx >= 0) & (cx < self.columns) & (cy >= 0) & (cy < self.rows)
+        cell = (cy * self.columns + cx).astype(np.int64)
+        k = np.minimum(np.searchsorted(self.cells, cell), len(self.cells) - 1)
+        occupied = inside & (self.cells[k] == cell)
+        starts = np.where(occupied, self.cell_offsets[k], 0)
+        lengths = np.where(occupied, self.cell_offsets[k + 1] - starts, 0)
+        owner = np.repeat(np.arange(len(cell)), lengths)
+        shift = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+        return shift + np.arange(lengths.sum()), owner
+
+    def nearest(self, points, tags=None, max_distance=None):
+        # The snapshot nodes nearest to each of the (latitude, longitude)
+        # points, and their distances in meters. With tags, only consider
+        # nodes on edges with one of these tags. A point without such a
+        # node within max_distance meters gets node -1 at distance inf.
+        max_distance = max_distance or common.max_snap_distance
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        x, y = geo.project(points[:, 0], points[:, 1])
+        x, y = x - self.x0, y - self.y0
+        px = np.floor(x / self.cell_size).astype(np.int64)
+        py = np.floor(y / self.cell_size).astype(np.int64)
+        mask = np.uint32(0xFFFFFFFF)
+        if tags is not None:
+            mask = np.uint32(sum(1 << common.edge_tags.get(t, t) for t in tags))
+
+        # The search of a point starts at the first ring of cells that
+        # reaches the grid, and stops at the ring that covers the whole
+        # grid, or at the ring beyond max_distance.
+        first_ring = np.maximum.reduce(
+            [-px, px - self.columns + 1, -py, py - self.rows + 1, 0 * px]
+        )
+        last_ring = np.maximum.reduce(
+            [px, self.columns - 1 - px, py, self.rows - 1 - py]
+        )
+        best = np.full(len(points), np.inf)
+        node = np.full(len(points), -1, dtype=np.int64)
+        active = np.flatnonzero(
+            (first_ring - 1) * self.cell_size <= max_distance
+        )
+        r = first_ring.copy()
+        while len(active) > 0:
+            point, dx, dy = ring_cells(active, r[active])
+            cx, cy = px[point] + dx, py[point] + dy
+            positions, owner = self.candidates(cx, cy)
+            point = point[owner]
+            allowed = (self.tag_mask[positions] & mask) != 0
+            positions, point = positions[allowed], point[allowed]
+            dist = np.hypot(
+                self.x[positions] - x[point], self.y[positions] - y[point]
+            )
+            # the nearest candidate per point
+            order = np.lexsort((dist, point))
+            first = np.ones(len(order), dtype=bool)
+            first[1:] = point[order][1:] != point[order][:-1]
+            order = order[first]
+            closer = dist[order] < best[point[order]]
+            hit = point[order][closer]
+            best[hit] = dist[order][closer]
+            node[hit] = self.nodes[positions[order][closer]]
+            # A node outside the searched square lies at least r cells away.
+            near = r[active] * self.cell_size
+            active = active[
+                (best[active] > near)
+                & (near < max_distance)
+                & (last_ring[active] > r[active])
+            ]
+            r[active] += 1
+        far = best > max_distance
+        node[far], best[far] = -1, np.inf
+        return node, best
+
+
+def ring_cells(points, r):
+    # The 8 r cells at distance r from the cell of each point, 1 cell for
+    # r = 0, as the point and the offsets dx and dy of each cell. The cells
+    # go around the four sides of the square, 2 r cells per side.
+    counts = np.maximum(8 * r, 1)
+    owner = np.repeat(np.arange(len(points)), counts)
+    k = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    r = r[owner]
+    side = 2 * np.maximum(r, 1)
+    j = k % side
+    dx = np.select(
+        [k < side, k < 2 * side, k < 3 * side], [j - r, r, r - j], -r
+    )
+    dy = np.select(
+        [k < side, k < 2 * side, k < 3 * side], [-r, j - r, r], r - j
+    )
+    return points[owner], dx, dy
+
+
+def build_snap_index(G, directory=common.snap_dir, cell_size=250.0):
+    t.tic()
+    x, y = geo.project(np.asarray(G.latitude), np.asarray(G.longitude))
+    x0, y0 = x.min(), y.min()
+    x, y = x - x0, y - y0
+    columns = int(x.max() // cell_size) + 1
+    rows = int(y.max() // cell_size) + 1
+    cell = (y // cell_size).astype(np.int64) * columns
+    cell += (x // cell_size).astype(np.int64)
+    nodes = np.argsort(cell, kind="stable")
+    cells, counts = np.unique(cell[nodes], return_counts=True)
+    cell_offsets = np.zeros(len(cells) + 1, dtype=np.int64)
+    np.cumsum(counts, out=cell_offsets[1:])
+
+    src = np.repeat(np.arange(G.number_of_nodes()), np.diff(G.offsets))
+    tag_mask = np.zeros(G.number_of_nodes(), dtype=np.uint32)
+    bits = np.left_shift(1, np.asarray(G.tag), dtype=np.uint32)
+    np.bitwise_or.at(tag_mask, src, bits)
+
+    index = {
+        "grid": np.array([x0, y0, cell_size, columns, rows]),
+        "cells": cells,
+        "cell_offsets": cell_offsets,
+        "nodes": nodes.astype(np.int32),
+        "x": x[nodes].astype(np.float32),
+        "y": y[nodes].astype(np.float32),
+        "tag_mask": tag_mask[nodes],
+    }
+    os.makedirs(directory, exist_ok=True)
+    for name in SnapIndex.arrays:
+        np.save(os.path.join(directory, name + ".npy"), index[name])
+    print(f"snap index with {len(cells)} cells written to {directory}")
+    t.toc()
+
+
+def main():
+    G = Graph()
+    build_snap_index(G)
+
+
+if __name__ == '__main__':
+    main()
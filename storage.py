@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+import os
+import time
+import numpy as np
+
+import common
+import geo
+from database import DB
+
+from pytictoc import TicToc
+
+t = TicToc()
+
+# Two ways to store the nodes and edges tables, with the same methods, so
+# that the code that reads whole tables, such as build_snapshot, can use
+# either; common.storage selects one. The columns come as a dict of numpy
+# arrays. The SQLite storage reads them with a query; the column storage
+# keeps a .npy file per column that is memory mapped, so that reading a
+# column copies nothing. The column storage is exported from the tables
+# once they are complete, see the pipeline, and exported again after an
+# update, which adds and removes rows.
+node_dtype = {
+    "id": np.int64,
+    "node_id": np.int64,
+    "idx": np.int64,
+    "latitude": np.float64,
+    "longitude": np.float64,
+}
+edge_dtype = {
+    "id": np.int64,
+    "node_from": np.int64,
+    "node_to": np.int64,
+    "tag": np.uint8,
+    "way_id": np.int64,
+    "length": np.float64,
+    "near_trunk": np.uint8,
+    "near_primary": np.uint8,
+    "dist_trunk": np.float32,
+    "dist_primary": np.float32,
+    "dist_secondary": np.float32,
+    "scenic": np.float32,
+    "cost": np.float64,
+}
+
+block_size = 1 << 16  # rows per block of the column storage
+cell_size = 1000.0  # meters, the grid that orders the nodes
+
+
+class SQLite_Storage:
+    def __init__(self, db):
+        self.db = db
+
+    def nodes(self, columns, box=None):
+        # The nodes, or the nodes in the box north, west, south, east,
+        # found through the R*Tree. The R*Tree rounds to single precision,
+        # so the exact test is on the nodes.
+        sql = "SELECT " + ", ".join(f"nodes.{c}" for c in columns)
+        sql += " FROM nodes"
+        if box is not None:
+            north, west, south, east = box
+            sql += (
+                " JOIN node_rtree ON node_rtree.id = nodes.id"
+                f" WHERE node_rtree.max_lat >= {south}"
+                f" AND node_rtree.min_lat <= {north}"
+                f" AND node_rtree.max_lon >= {west}"
+                f" AND node_rtree.min_lon <= {east}"
+                f" AND nodes.latitude BETWEEN {south} AND {north}"
+                f" AND nodes.longitude BETWEEN {west} AND {east}"
+            )
+        rows = self.db.execute_array(
+            sql + ";", [(c, node_dtype[c]) for c in columns]
+        )
+        return {c: rows[c] for c in columns}
+
+    def edges(self, columns, tags=None):
+        # The edges, or the edges with one of the tags.
+        sql = "SELECT " + ", ".join(columns) + " FROM edges"
+        if tags is not None:
+            sql += f" WHERE tag IN ({','.join(str(t) for t in tags)})"
+        rows = self.db.execute_array(
+            sql + ";", [(c, edge_dtype[c]) for c in columns]
+        )
+        return {c: rows[c] for c in columns}
+
+
+class Column_Storage:
+    # A directory per table, with a .npy file per column. The nodes are in
+    # the Z order of the cells of a grid, so that the nodes of a block lie
+    # close together, and the edges are in the order of their tags. For
+    # each block of block_size rows, the zones files hold the smallest and
+    # largest latitude and longitude of the nodes, and the smallest and
+    # largest tag of the edges; a query with a box or tags only reads the
+    # blocks whose zones overlap it.
+    def __init__(self, directory=common.columns_dir, mmap_mode="r"):
+        self.directory = directory
+        self.mmap_mode = mmap_mode
+
+    def column(self, table, name):
+        fname = os.path.join(self.directory, table, name + ".npy")
+        return np.load(fname, mmap_mode=self.mmap_mode)
+
+    def blocks(self, table, **ranges):
+        # The rows of the blocks in which each column may have values
+        # between the low and high of its range.
+        size = len(self.column(table, "id"))
+        hit = np.ones((size + block_size - 1) // block_size, dtype=bool)
+        for name, (low, high) in ranges.items():
+            zones = self.column(table, "zones_" + name)
+            hit &= (zones[:, 1] >= low) & (zones[:, 0] <= high)
+        starts = np.flatnonzero(hit) * block_size
+        lengths = np.minimum(starts + block_size, size) - starts
+        shift = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+        return shift + np.arange(lengths.sum())
+
+    def nodes(self, columns, box=None):
+        if box is None:
+            return {c: self.column("nodes", c) for c in columns}
+        north, west, south, east = box
+        rows = self.blocks(
+            "nodes", latitude=(south, north), longitude=(west, east)
+        )
+        lat = self.column("nodes", "latitude")[rows]
+        lon = self.column("nodes", "longitude")[rows]
+        inside = (lat >= south) & (lat <= north)
+        inside &= (lon >= west) & (lon <= east)
+        rows = rows[inside]
+        return {c: self.column("nodes", c)[rows] for c in columns}
+
+    def edges(self, columns, tags=None):
+        if tags is None:
+            return {c: self.column("edges", c) for c in columns}
+        tags = sorted(tags)
+        rows = self.blocks("edges", tag=(tags[0], tags[-1]))
+        rows = rows[np.isin(self.column("edges", "tag")[rows], tags)]
+        return {c: self.column("edges", c)[rows] for c in columns}
+
+
+def open_storage(db, kind=None):
+    kind = kind or common.storage
+    if kind == "sqlite":
+        return SQLite_Storage(db)
+    if kind == "columns":
+        return Column_Storage()
+    raise ValueError(f"Unknown storage {kind}")
+
+
+def z_order(cx, cy):
+    # Interleave the bits of the cell numbers, which are less than 2**16.
+    def spread(v):
+        v = v & 0xFFFF
+        v = (v | (v << 8)) & 0x00FF00FF
+        v = (v | (v << 4)) & 0x0F0F0F0F
+        v = (v | (v << 2)) & 0x33333333
+        return (v | (v << 1)) & 0x55555555
+
+    return spread(cx) | (spread(cy) << 1)
+
+
+def zones(column):
+    # The smallest and largest value of each block of the column.
+    starts = np.arange(0, len(column), block_size)
+    low = np.minimum.reduceat(column, starts)
+    high = np.maximum.reduceat(column, starts)
+    return np.column_stack([low, high])
+
+
+def write_table(directory, columns, order, zoned):
+    os.makedirs(directory, exist_ok=True)
+    for name, column in columns.items():
+        column = column[order]
+        np.save(os.path.join(directory, name + ".npy"), column)
+        if name in zoned:
+            fname = os.path.join(directory, "zones_" + name + ".npy")
+            np.save(fname, zones(column))
+
+
+def export_columns(db, directory=common.columns_dir):
+    # Write the tables to a column storage.
+    t.tic()
+    tables = SQLite_Storage(db)
+    nodes = tables.nodes(list(node_dtype))
+    x, y = geo.project(nodes["latitude"], nodes["longitude"])
+    cx = ((x - x.min()) // cell_size).astype(np.int64)
+    cy = ((y - y.min()) // cell_size).astype(np.int64)
+    order = np.argsort(z_order(cx, cy), kind="stable")
+    write_table(
+        os.path.join(directory, "nodes"),
+        nodes,
+        order,
+        zoned=["latitude", "longitude"],
+    )
+    edges = tables.edges(list(edge_dtype))
+    order = np.argsort(edges["tag"], kind="stable")
+    write_table(os.path.join(directory, "edges"), edges, order, zoned=["tag"])
+    print(
+        f"{len(nodes['id'])} nodes and {len(edges['id'])} edges "
+        f"written to {directory}"
+    )
+    t.toc()
+
+
+def benchmark(db, repeat=3):
+    # The best of repeat times of some queries on either storage.
+    nodes = SQLite_Storage(db).nodes(["latitude", "longitude"])
+    lat = float(np.median(nodes["latitude"]))
+    lon = float(np.median(nodes["longitude"]))
+    box = (lat + 0.05, lon - 0.08, lat - 0.05, lon + 0.08)
+    primary = sorted(common.primary_tags)
+    queries = {
+        "all nodes": lambda s: s.nodes(["node_id", "latitude", "longitude"]),
+        "nodes in box": lambda s: s.nodes(
+            ["idx", "latitude", "longitude"], box
+        ),
+        "all edges": lambda s: s.edges(["node_from", "node_to", "cost"]),
+        "primary edges": lambda s: s.edges(["node_from", "node_to"], primary),
+    }
+    for kind in ("sqlite", "columns"):
+        storage = open_storage(db, kind)
+        for name, query in queries.items():
+            times = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                result = query(storage)
+                # touch the data, memory mapped columns are read lazily
+                sum(float(np.sum(c)) for c in result.values())
+                times.append(time.perf_counter() - start)
+            rows = len(next(iter(result.values())))
+            print(f"{kind:<8}{name:<15}{rows:>10} rows {min(times):>8.3f} s")
+
+
+def main():
+    db = DB()
+    export_columns(db)
+    benchmark(db)
+    db.close_connection()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+import atexit
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest import mock
+from urllib.error import HTTPError
+from urllib.request import urlopen
+
+import common
+
+# The modules take their directories from common when they are imported,
+# so the data of the test must be set before. The tests of a run share the
+# directory, as the modules keep the directories of the first import.
+data_dir = os.path.join(tempfile.gettempdir(), f"track_walking_{os.getpid()}/")
+os.makedirs(data_dir, exist_ok=True)
+atexit.register(shutil.rmtree, data_dir, ignore_errors=True)
+
+
+def use_data_dir():
+    common.db_name = data_dir + "nodes_and_edges.db"
+    common.snapshot_dir = data_dir + "snapshot/"
+    common.ch_dir = data_dir + "ch/"
+    common.snap_dir = data_dir + "snap/"
+    common.storage = "sqlite"
+
+
+use_data_dir()
+
+from database import DB  # noqa: E402
+from graph import build_snapshot  # noqa: E402
+from port_info_to_database import (  # noqa: E402
+    compute_edge_cost,
+    compute_edge_length,
+)
+import server  # noqa: E402
+
+
+def make_grid(n=5):
+    # A grid of n by n nodes about 100 meters apart, with footways, without
+    # the hierarchy and snap index that other tests may have left.
+    for directory in (common.ch_dir, common.snap_dir):
+        shutil.rmtree(directory, ignore_errors=True)
+    db = DB()
+    db.rebuild()
+    ids = [[1 + i * n + j for j in range(n)] for i in range(n)]
+    node_id, lat, lon = [], [], []
+    for i in range(n):
+        for j in range(n):
+            node_id.append(ids[i][j])
+            lat.append(52 + 0.001 * i)
+            lon.append(6 + 0.0015 * j)
+    # a node without edges, nearer to the snap test than node 1
+    db.add_nodes(node_id + [100], lat + [52.0001], lon + [6.0])
+    left, right = [], []
+    for i in range(n):
+        for j in range(n):
+            if j + 1 < n:
+                left.append(ids[i][j])
+                right.append(ids[i][j + 1])
+            if i + 1 < n:
+                left.append(ids[i][j])
+                right.append(ids[i + 1][j])
+    footway = common.edge_tags["footway"]
+    db.add_edges(left, right, [footway] * len(left), range(len(left)))
+    db.assign_node_indexes()
+    db.make_indexes()
+    compute_edge_length(db, where="1")
+    compute_edge_cost(db)
+    build_snapshot(db)
+    db.close_connection()
+
+
+class ServerTest(unittest.TestCase):
+    # A server on a free port, without hierarchy and without snap index.
+    @classmethod
+    def setUpClass(cls):
+        use_data_dir()
+        make_grid()
+        cls.server = server.make_server(port=0, connections=2)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.base = f"http://127.0.0.1:{cls.server.server_address[1]}"
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        cls.server.connections.close()
+
+    def get(self, query):
+        try:
+            with urlopen(self.base + query) as r:
+                return r.status, r.headers["Content-Type"], r.read().decode()
+        except HTTPError as e:
+            return e.code, e.headers["Content-Type"], e.read().decode()
+
+    def test_route(self):
+        status, content_type, body = self.get(
+            "/route?points=52.0,6.0;52.004,6.006"
+        )
+        self.assertEqual(status, 200)
+        self.assertEqual(content_type, "application/geo+json")
+        self.assertEqual(json.loads(body)["type"], "FeatureCollection")
+
+    def test_stats(self):
+        status, _, body = self.get("/stats?points=52.0,6.0;52.004,6.0")
+        self.assertEqual(status, 200)
+        self.assertAlmostEqual(json.loads(body)["length"], 445, delta=5)
+
+    def test_snap_without_snap_index(self):
+        status, _, body = self.get("/snap?points=52.0001,6.0")
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(body)[0]["node_id"], 1)
+
+    def test_bad_requests(self):
+        self.assertEqual(self.get("/route?points=52.0,6.0")[0], 400)
+        self.assertEqual(self.get("/route?points=52.0")[0], 400)
+        self.assertEqual(self.get("/nothing")[0], 404)
+
+    def test_unexpected_error(self):
+        def fail(server, query):
+            raise IndexError("out of range")
+
+        with mock.patch.dict(server.Routing_Handler.requests, {"/fail": fail}):
+            status, content_type, body = self.get("/fail")
+        self.assertEqual(status, 500)
+        self.assertEqual(content_type, "application/json")
+        self.assertEqual(json.loads(body)["error"], "IndexError: out of range")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,262 @@
+import atexit
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+from unittest import mock
+
+import osmium
+
+import common
+
+# The modules take their directories from common when they are imported,
+# so the data of the test must be set before. The tests of a run share the
+# directory, as the modules keep the directories of the first import.
+data_dir = os.path.join(tempfile.gettempdir(), f"track_walking_{os.getpid()}/")
+os.makedirs(data_dir, exist_ok=True)
+atexit.register(shutil.rmtree, data_dir, ignore_errors=True)
+
+
+def use_data_dir():
+    common.data_dir = data_dir
+    common.db_name = data_dir + "nodes_and_edges.db"
+    common.snapshot_dir = data_dir + "snapshot/"
+    common.ch_dir = data_dir + "ch/"
+    common.compressed_dir = data_dir + "compressed/"
+    common.snap_dir = data_dir + "snap/"
+    common.tiles_dir = data_dir + "tiles/"
+    common.columns_dir = data_dir + "columns/"
+    common.scenery_file = data_dir + "scenery.npz"
+    common.storage = "sqlite"
+    common.provinces = ["west", "east"]
+
+
+use_data_dir()
+
+from database import DB  # noqa: E402
+from pipeline import run_pipeline  # noqa: E402
+import update  # noqa: E402
+
+# A grid of n by n nodes about 100 meters apart, read as two provinces that
+# overlap in the middle columns.
+n = 8
+provinces = {"west": range(0, 5), "east": range(3, n)}
+
+
+def node_id(i, j):
+    return 1 + i * n + j
+
+
+def grid():
+    # The ways, as way_id: (tags, node ids), and the positions of the nodes.
+    positions = {
+        node_id(i, j): (52 + 0.001 * i, 6 + 0.0015 * j)
+        for i in range(n)
+        for j in range(n)
+    }
+    positions[900] = (52.0075, 6.0105)
+    positions[901] = (52.008, 6.0108)
+    ways = {}
+    for i in range(n):
+        ways[100 + i] = (
+            {"highway": "footway"},
+            [node_id(i, j) for j in range(n)],
+        )
+    ways[104] = ({"highway": "secondary"}, ways[104][1])
+    for j in range(n):
+        ways[200 + j] = (
+            {"highway": "track"},
+            [node_id(i, j) for i in range(n)],
+        )
+    # shares the start of row 2, which keeps the edges
+    ways[300] = ({"highway": "path"}, [node_id(2, j) for j in range(4)])
+    # shares the start of column 5, and has the edges
+    ways[50] = ({"highway": "cycleway"}, [node_id(i, 5) for i in range(3)])
+    # a spur at the corner of the grid
+    ways[401] = ({"highway": "path"}, [node_id(7, 7), 900])
+    ways[400] = ({"highway": "path"}, [900, 901])
+    ways[600] = (
+        {"landuse": "forest"},
+        [node_id(0, 0), node_id(0, 3), node_id(3, 3), node_id(3, 0)]
+        + [node_id(0, 0)],
+    )
+    return ways, positions
+
+
+def column(lon):
+    return round((lon - 6) / 0.0015)
+
+
+def write_provinces(ways, positions):
+    for province, columns in provinces.items():
+        fname = data_dir + province + "-latest.osm.pbf"
+        selected = {
+            w: way
+            for w, way in ways.items()
+            if any(column(positions[v][1]) in columns for v in way[1])
+        }
+        nodes = sorted(set(v for _, refs in selected.values() for v in refs))
+        writer = osmium.SimpleWriter(fname, overwrite=True)
+        for v in nodes:
+            lat, lon = positions[v]
+            writer.add_node(osmium.osm.mutable.Node(id=v, location=(lon, lat)))
+        for w in sorted(selected):
+            tags, refs = selected[w]
+            writer.add_way(osmium.osm.mutable.Way(id=w, nodes=refs, tags=tags))
+        writer.close()
+
+
+def change(ways, positions):
+    # The ways and positions after the change, and the change file.
+    ways, positions = dict(ways), dict(positions)
+    moved = node_id(1, 1)
+    positions[moved] = (52.0012, 6.0013)
+    positions[1000] = (52.0035, 6.0055)
+    ways[500] = (
+        {"highway": "track"},
+        [node_id(3, 3), 1000, node_id(4, 4)],
+    )
+    ways[101] = ({"highway": "primary"}, ways[101][1])
+    # row 2 goes to way 300, column 5 to way 205, and row 6 to way 50
+    del ways[102]
+    ways[50] = ({"highway": "cycleway"}, [node_id(6, j) for j in range(4)])
+    # the spur is cut off
+    del ways[401]
+    fname = data_dir + "change.osc"
+    writer = osmium.SimpleWriter(fname, overwrite=True)
+    for v, version in ((1000, 1), (moved, 2)):
+        lat, lon = positions[v]
+        writer.add_node(
+            osmium.osm.mutable.Node(id=v, version=version, location=(lon, lat))
+        )
+    for w, version in ((500, 1), (101, 2), (50, 2)):
+        tags, refs = ways[w]
+        writer.add_way(
+            osmium.osm.mutable.Way(id=w, version=version, nodes=refs, tags=tags)
+        )
+    # node 999 is nowhere, so way 203 keeps its edges
+    writer.add_way(
+        osmium.osm.mutable.Way(
+            id=203,
+            version=2,
+            nodes=ways[203][1] + [999],
+            tags={"highway": "primary"},
+        )
+    )
+    for w in (102, 401):
+        writer.add_way(
+            osmium.osm.mutable.Way(id=w, version=2, visible=False, nodes=[])
+        )
+    writer.close()
+    return ways, positions, fname
+
+
+def import_provinces(ways, positions, fname):
+    # A full import of the provinces, in the database file fname.
+    write_provinces(ways, positions)
+    common.db_name = fname
+    db = DB()
+    run_pipeline(db)
+    db.close_connection()
+
+
+def rows(fname, sql):
+    connection = sqlite3.connect(fname)
+    result = connection.execute(sql).fetchall()
+    connection.close()
+    return result
+
+
+def edges(fname):
+    # The edges by their pair of nodes.
+    return {
+        (min(r[0], r[1]), max(r[0], r[1])): r
+        for r in rows(
+            fname,
+            "SELECT node_from, node_to, tag, way_id, length, dist_trunk, "
+            "dist_primary, dist_secondary, scenic, cost FROM edges;",
+        )
+    }
+
+
+def shared_edges(fname):
+    return sorted(
+        rows(
+            fname,
+            "SELECT way_id, node_from, node_to, tag FROM shared_edges;",
+        )
+    )
+
+
+class UpdateTest(unittest.TestCase):
+    # An update of the grid equals a full import of the changed grid.
+    @classmethod
+    def setUpClass(cls):
+        use_data_dir()
+        ways, positions = grid()
+        cls.base = data_dir + "base.db"
+        import_provinces(ways, positions, cls.base)
+        ways, positions, cls.changes = change(ways, positions)
+        cls.full = data_dir + "full.db"
+        import_provinces(ways, positions, cls.full)
+        cls.updated = data_dir + "updated.db"
+        shutil.copy(cls.base, cls.updated)
+        common.db_name = cls.updated
+        db = DB()
+        update.apply_changes(db, cls.changes)
+        db.close_connection()
+
+    def test_edges(self):
+        full, updated = edges(self.full), edges(self.updated)
+        self.assertEqual(full.keys(), updated.keys())
+        for pair, row in full.items():
+            self.assertEqual(row[:4], updated[pair][:4], pair)
+            for a, b in zip(row[4:], updated[pair][4:]):
+                self.assertAlmostEqual(a, b, places=3, msg=pair)
+
+    def test_shared_edges(self):
+        self.assertEqual(
+            shared_edges(self.full), shared_edges(self.updated)
+        )
+
+    def test_hand_over(self):
+        owners = {pair: row[3] for pair, row in edges(self.updated).items()}
+        self.assertEqual(owners[node_id(2, 0), node_id(2, 1)], 300)
+        self.assertEqual(owners[node_id(0, 5), node_id(1, 5)], 205)
+        self.assertEqual(owners[node_id(6, 0), node_id(6, 1)], 50)
+        self.assertIn(
+            (106, node_id(6, 0), node_id(6, 1), common.edge_tags["footway"]),
+            shared_edges(self.updated),
+        )
+
+    def test_broken_way_and_pruning(self):
+        base, updated = edges(self.base), edges(self.updated)
+        # way 203 is column 3
+        for pair in [(node_id(i, 3), node_id(i + 1, 3)) for i in range(n - 1)]:
+            self.assertEqual(base[pair][:4], updated[pair][:4])
+        self.assertIn((900, 901), base)
+        self.assertNotIn((900, 901), updated)
+
+    def test_rollback(self):
+        # A crash in the update leaves the tables as they were.
+        fname = data_dir + "crashed.db"
+        shutil.copy(self.base, fname)
+        common.db_name = fname
+        db = DB()
+        with mock.patch.object(
+            update, "compute_edge_cost", side_effect=RuntimeError("crash")
+        ):
+            with self.assertRaises(RuntimeError):
+                update.apply_changes(db, self.changes)
+        db.close_connection()
+        for sql in (
+            "SELECT * FROM edges ORDER BY id;",
+            "SELECT * FROM nodes ORDER BY id;",
+            "SELECT * FROM shared_edges ORDER BY rowid;",
+        ):
+            self.assertEqual(rows(self.base, sql), rows(fname, sql))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+import os
+import numpy as np
+
+import common
+import geo
+from compress import edge_positions
+from graph import Graph
+from profiles import get_profile
+from routing import bidirectional_astar
+
+from pytictoc import TicToc
+
+t = TicToc()
+
+# The snapshot graph cut in square tiles of tile_size meters, each tile in
+# a file of its own. The nodes are numbered tile by tile: the nodes of
+# tile k are tile_offsets[k], ..., tile_offsets[k + 1] - 1, so the tile of
+# a node follows from a search in the small tile_offsets array, and an
+# edge to a node in another tile needs no extra bookkeeping. Within a tile
+# the nodes are in the order of their snapshot numbers, which are in the
+# nodes array of the tile.
+tile_size = 5000.0
+corridor = 5000.0  # the tiles loaded in advance lie this close to the route
+
+
+class Tile:
+    arrays = ["nodes", "offsets", "neighbors", "cost", "coordinates"]
+
+    def __init__(self, fname):
+        with np.load(fname) as data:
+            for name in self.arrays:
+                setattr(self, name, data[name])
+
+
+class Column:
+    # G.latitude[v] and G.longitude[v] for the nodes of a tiled graph.
+    def __init__(self, graph, column):
+        self.graph = graph
+        self.column = column
+
+    def __getitem__(self, v):
+        tile, i = self.graph.locate(v)
+        return tile.coordinates[i, self.column]
+
+
+class TiledGraph:
+    # Like Graph, but it holds only the tiles it needed so far; a search
+    # that reaches a node in another tile loads that tile. G is the
+    # snapshot, of which only the coordinates of the end points of the
+    # paths are read.
+    def __init__(self, G, directory=common.tiles_dir):
+        self.G = G
+        self.directory = directory
+        with np.load(os.path.join(directory, "index.npz")) as data:
+            self.grid = data["grid"]
+            self.tile_keys = data["tile_keys"]
+            self.tile_offsets = data["tile_offsets"]
+        self.x0, self.y0, self.size, self.columns = self.grid
+        self.tiles = {}
+        self.latitude = Column(self, 0)
+        self.longitude = Column(self, 1)
+
+    def number_of_nodes(self):
+        return int(self.tile_offsets[-1])
+
+    def tile(self, k):
+        if k not in self.tiles:
+            fname = os.path.join(self.directory, f"tile_{k}.npz")
+            self.tiles[k] = Tile(fname)
+        return self.tiles[k]
+
+    def locate(self, v):
+        k = int(np.searchsorted(self.tile_offsets, v, side="right")) - 1
+        return self.tile(k), v - int(self.tile_offsets[k])
+
+    def adjacent(self, v):
+        tile, i = self.locate(v)
+        start, stop = tile.offsets[i], tile.offsets[i + 1]
+        return tile.neighbors[start:stop], tile.cost[start:stop]
+
+    def min_cost_factor(self):
+        return get_profile("default").min_cost_factor()
+
+    def tiled_number(self, node, latitude, longitude):
+        # The number of the snapshot node at latitude, longitude.
+        x, y = geo.project(latitude, longitude)
+        key = int((y - self.y0) // self.size) * int(self.columns)
+        key += int((x - self.x0) // self.size)
+        k = int(np.searchsorted(self.tile_keys, key))
+        i = int(np.searchsorted(self.tile(k).nodes, node))
+        return int(self.tile_offsets[k]) + i
+
+    def snapshot_number(self, v):
+        tile, i = self.locate(v)
+        return int(tile.nodes[i])
+
+    def load_corridor(self, points):
+        # Load the tiles within corridor meters of the polyline through the
+        # (latitude, longitude) points.
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        x, y = geo.project(points[:, 0], points[:, 1])
+        cx = (self.tile_keys % self.columns + 0.5) * self.size + self.x0
+        cy = (self.tile_keys // self.columns + 0.5) * self.size + self.y0
+        near = np.zeros(len(self.tile_keys), dtype=bool)
+        reach = corridor + self.size / np.sqrt(2)  # center to corner
+        for x1, y1, x2, y2 in zip(x, y, x[1:], y[1:]):
+            dx, dy = x2 - x1, y2 - y1
+            s = ((cx - x1) * dx + (cy - y1) * dy) / max(dx * dx + dy * dy, 1)
+            s = np.clip(s, 0, 1)
+            near |= np.hypot(cx - x1 - s * dx, cy - y1 - s * dy) <= reach
+        if len(x) == 1:
+            near |= np.hypot(cx - x[0], cy - y[0]) <= reach
+        for k in np.flatnonzero(near).tolist():
+            self.tile(k)
+
+    def shortest_path(self, source, target):
+        # source and target are snapshot nodes, and so are the nodes of the
+        # path.
+        G = self.G
+        s, t = [
+            self.tiled_number(n, float(G.latitude[n]), float(G.longitude[n]))
+            for n in (source, target)
+        ]
+        path, settled = bidirectional_astar(self, s, t)
+        return [self.snapshot_number(v) for v in path], settled
+
+
+def build_tiles(G, directory=common.tiles_dir, size=tile_size):
+    t.tic()
+    x, y = geo.project(np.asarray(G.latitude), np.asarray(G.longitude))
+    x0, y0 = x.min(), y.min()
+    columns = int((x.max() - x0) // size) + 1
+    key = ((y - y0) // size).astype(np.int64) * columns
+    key += ((x - x0) // size).astype(np.int64)
+    # by tile, and within a tile by snapshot number
+    order = np.lexsort((np.arange(len(key)), key))
+    tiled = np.empty(len(order), dtype=np.int64)
+    tiled[order] = np.arange(len(order))
+    tile_keys, counts = np.unique(key[order], return_counts=True)
+    tile_offsets = np.zeros(len(tile_keys) + 1, dtype=np.int64)
+    np.cumsum(counts, out=tile_offsets[1:])
+
+    offsets = np.asarray(G.offsets)
+    os.makedirs(directory, exist_ok=True)
+    for k in range(len(tile_keys)):
+        nodes = order[tile_offsets[k] : tile_offsets[k + 1]]
+        edges = edge_positions(offsets, nodes)
+        local_offsets = np.zeros(len(nodes) + 1, dtype=np.int64)
+        np.cumsum(offsets[nodes + 1] - offsets[nodes], out=local_offsets[1:])
+        np.savez(
+            os.path.join(directory, f"tile_{k}.npz"),
+            nodes=nodes.astype(np.int32),
+            offsets=local_offsets,
+            neighbors=tiled[np.asarray(G.neighbors)[edges]],
+            cost=np.asarray(G.cost)[edges],
+            coordinates=np.asarray(G.coordinates)[nodes],
+        )
+    np.savez(
+        os.path.join(directory, "index.npz"),
+        grid=np.array([x0, y0, size, columns]),
+        tile_keys=tile_keys,
+        tile_offsets=tile_offsets,
+    )
+    print(f"{len(tile_keys)} tiles written to {directory}")
+    t.toc()
+
+
+def main():
+    G = Graph()
+    build_tiles(G)
+
+
+if __name__ == '__main__':
+    main()
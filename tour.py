@@ -0,0 +1,102 @@
+import numpy as np
+
+# The order in which to visit a number of waypoints, given the matrix of
+# the costs between them. The walk starts at waypoint 0 and ends at the
+# last waypoint, or, for a round trip, back at waypoint 0; the waypoints
+# in between may be visited in any order. An order is a list of waypoint
+# numbers from the start to the end; for a round trip the last number is 0
+# again. Since the graph is undirected, the cost matrix is symmetric, so
+# reversing part of an order does not change the cost of that part.
+
+
+def order_cost(costs, order):
+    return float(costs[order[:-1], order[1:]].sum())
+
+
+def nearest_insertion(costs, round_trip=False):
+    # Repeatedly take the waypoint that is nearest to one of the waypoints
+    # of the order so far, and insert it where it adds the least cost.
+    n = len(costs)
+    end = 0 if round_trip else n - 1
+    order = [0, end] if n > 1 else [0]
+    todo = np.ones(n, dtype=bool)
+    todo[order] = False
+    while todo.any():
+        candidates = np.flatnonzero(todo)
+        nearest = costs[np.ix_(order, candidates)].min(axis=0)
+        v = int(candidates[np.argmin(nearest)])
+        a, b = np.array(order[:-1]), np.array(order[1:])
+        extra = costs[a, v] + costs[v, b] - costs[a, b]
+        order.insert(int(np.argmin(extra)) + 1, v)
+        todo[v] = False
+    return order
+
+
+def two_opt(costs, order):
+    # Reverse the part order[i + 1 : k + 1] when that makes the walk
+    # cheaper, until no reversal does. The first and last waypoint stay.
+    order = list(order)
+    improved = True
+    while improved:
+        improved = False
+        for i in range(len(order) - 3):
+            a, b = order[i], order[i + 1]
+            for k in range(i + 2, len(order) - 1):
+                c, d = order[k], order[k + 1]
+                delta = costs[a, c] + costs[b, d] - costs[a, b] - costs[c, d]
+                if delta < -1e-9:
+                    order[i + 1 : k + 1] = order[i + 1 : k + 1][::-1]
+                    a, b = order[i], order[i + 1]
+                    improved = True
+    return order
+
+
+def or_opt(costs, order, max_length=3):
+    # Move a run of at most max_length waypoints, possibly reversed, to
+    # another place in the order when that makes the walk cheaper.
+    order = list(order)
+    improved = True
+    while improved:
+        improved = False
+        for length in range(1, max_length + 1):
+            for i in range(1, len(order) - length):
+                run = order[i : i + length]
+                before, after = order[i - 1], order[i + length]
+                gain = (
+                    costs[before, run[0]]
+                    + costs[run[-1], after]
+                    - costs[before, after]
+                )
+                rest = order[:i] + order[i + length :]
+                best, where, flip = -1e-9, None, False
+                for j in range(len(rest) - 1):
+                    a, b = rest[j], rest[j + 1]
+                    if (a, b) == (before, after):
+                        continue
+                    removed = costs[a, b]
+                    forward = costs[a, run[0]] + costs[run[-1], b] - removed
+                    backward = costs[a, run[-1]] + costs[run[0], b] - removed
+                    if forward - gain < best:
+                        best, where, flip = forward - gain, j, False
+                    if backward - gain < best:
+                        best, where, flip = backward - gain, j, True
+                if where is not None:
+                    run = run[::-1] if flip else run
+                    order = rest[: where + 1] + run + rest[where + 1 :]
+                    improved = True
+                    break
+            if improved:
+                break
+    return order
+
+
+def best_order(costs, round_trip=False):
+    costs = np.asarray(costs)
+    if np.isinf(costs).any():
+        raise ValueError("Not all waypoints can reach each other")
+    order = nearest_insertion(costs, round_trip)
+    while True:
+        cost = order_cost(costs, order)
+        order = or_opt(costs, two_opt(costs, order))
+        if order_cost(costs, order) >= cost - 1e-9:
+            return order
@@ -0,0 +1,417 @@
+#!/usr/bin/env python
+import argparse
+import os
+import shutil
+import numpy as np
+import osmium
+
+import common
+import geo
+from compress import compress
+from database import DB
+from graph import Graph, build_snapshot
+from port_info_to_database import (
+    compute_edge_cost,
+    compute_edge_length,
+    largest_component,
+    way_segments,
+)
+from proximity import (
+    compute_road_distances,
+    endpoints_dtype,
+    endpoints_sql,
+    road_classes,
+)
+import scenery
+from snap import build_snap_index
+from storage import export_columns
+from tiles import build_tiles
+
+from pytictoc import TicToc
+
+t = TicToc()
+
+# Bring the database up to date with OpenStreetMap change files, such as the
+# daily .osc.gz diffs of Geofabrik, instead of reading all provinces again.
+# Every edge knows the way it belongs to, and shared_edges the other ways
+# that have it, so a changed way is deleted and inserted anew, and a moved
+# node takes its edges along. An edge of a changed way that another way
+# shares goes to that way, like in a full import. Only these edges,
+# and the edges within neighbourhood meters of a trunk, primary or secondary
+# road that changed, get a new length, distances to roads, scenic score and
+# cost; further away the penalty of a road is negligible. Nodes are never
+# deleted, so that the numbers of the other nodes stay the same; a node
+# without edges is never snapped to.
+neighbourhood = 20 * max(
+    common.near_trunk_distance,
+    common.near_primary_distance,
+    common.near_secondary_distance,
+)
+
+road_tags = ",".join(str(t) for tags in road_classes.values() for t in tags)
+changed_edges_sql = (
+    "INSERT OR IGNORE INTO temp.changed_edges "
+    "SELECT id FROM edges "
+    "WHERE way_id IN (SELECT way_id FROM temp.changed_ways) "
+    "UNION SELECT edges.id FROM shared_edges AS s "
+    "JOIN edges USING (node_from, node_to) "
+    "WHERE s.way_id IN (SELECT way_id FROM temp.changed_ways) "
+    "UNION SELECT id FROM edges "
+    "WHERE node_from IN (SELECT node_id FROM temp.changed_nodes) "
+    "UNION SELECT id FROM edges "
+    "WHERE node_to IN (SELECT node_id FROM temp.changed_nodes);"
+)
+
+
+class Change_Handler(osmium.SimpleHandler):
+    # The nodes and ways of a change file. Of an object that changed more
+    # than once, the last version counts. A way that is deleted, or that is
+    # no longer a highway we know, maps to None.
+    def __init__(self):
+        osmium.SimpleHandler.__init__(self)
+        self.nodes = {}
+        self.ways = {}
+        self.tag_str_to_idx = {
+            tag_str: i for i, tag_str in enumerate(common.tags)
+        }
+
+    def node(self, n):
+        if n.deleted:
+            self.nodes.pop(n.id, None)
+        else:
+            self.nodes[n.id] = (n.location.lat, n.location.lon)
+
+    def way(self, w):
+        tag = self.tag_str_to_idx.get(w.tags.get("highway"))
+        if w.deleted or tag is None:
+            self.ways[w.id] = None
+        else:
+            self.ways[w.id] = (tag, [n.ref for n in w.nodes])
+
+
+# The edges with a shared segment, and the way with the smallest id of these
+# segments, the heir of the edge.
+heirs_sql = (
+    "CREATE TEMP TABLE heirs AS "
+    "SELECT edges.id, MIN(s.way_id) AS way_id, s.tag, "
+    "edges.way_id AS old_way_id, edges.tag AS old_tag, node_from, node_to "
+    "FROM edges JOIN shared_edges AS s USING (node_from, node_to) "
+)
+
+
+def select_changed_edges(db):
+    # Add the edges of the changed ways and the edges at the changed nodes
+    # to the changed edges.
+    db.execute(changed_edges_sql)
+
+
+def hand_over(db):
+    # Give the edges in temp.heirs to their heirs, whose segments no longer
+    # share the edges.
+    db.execute(
+        "UPDATE edges SET way_id = h.way_id, tag = h.tag "
+        "FROM temp.heirs AS h WHERE edges.id = h.id;"
+    )
+    db.execute(
+        "DELETE FROM shared_edges WHERE (way_id, node_from, node_to) IN "
+        "(SELECT way_id, node_from, node_to FROM temp.heirs);"
+    )
+    db.execute("DROP TABLE temp.heirs;")
+
+
+def delete_ways(db):
+    # Take the changed ways out of the edges and the shared segments. An
+    # edge of a changed way goes to its heir, if any.
+    db.execute(
+        "DELETE FROM shared_edges "
+        "WHERE way_id IN (SELECT way_id FROM temp.changed_ways);"
+    )
+    db.execute(
+        heirs_sql
+        + "WHERE edges.way_id IN (SELECT way_id FROM temp.changed_ways) "
+        + "GROUP BY edges.id;"
+    )
+    hand_over(db)
+    db.execute(
+        "DELETE FROM edges "
+        "WHERE way_id IN (SELECT way_id FROM temp.changed_ways);"
+    )
+
+
+def road_ends(db, table):
+    # The end points of the trunk, primary and secondary edges whose ids
+    # are in the temporary table.
+    edges = db.execute_array(
+        endpoints_sql
+        + f"WHERE tag IN ({road_tags}) "
+        + f"AND edges.id IN (SELECT id FROM temp.{table});",
+        endpoints_dtype,
+    )
+    lat = np.concatenate([edges["lat_from"], edges["lat_to"]])
+    lon = np.concatenate([edges["lon_from"], edges["lon_to"]])
+    return np.column_stack([lat, lon])
+
+
+def changed_highways(db, h):
+    # The segments of the changed highways, and the new nodes with their
+    # positions. A highway of which a node has no position, neither in the
+    # change file nor in the nodes table, can not be drawn; it is left out,
+    # and returned apart so that it keeps its edges as they were.
+    node_from, node_to, tag, way_id = [], [], [], []
+    for w, way in h.ways.items():
+        if way is None:
+            continue
+        refs = way[1]
+        node_from.extend(refs[:-1])
+        node_to.extend(refs[1:])
+        tag.extend([way[0]] * (len(refs) - 1))
+        way_id.extend([w] * (len(refs) - 1))
+    node_from = np.array(node_from, dtype=np.int64)
+    node_to = np.array(node_to, dtype=np.int64)
+    tag = np.array(tag, dtype=np.uint8)
+    way_id = np.array(way_id, dtype=np.int64)
+
+    refs = np.unique(np.concatenate([node_from, node_to]))
+    db.make_temp_table("refs", node_id=refs)
+    known = db.execute_array(
+        "SELECT nodes.node_id, latitude, longitude "
+        "FROM temp.refs JOIN nodes ON nodes.node_id = refs.node_id;",
+        [("node_id", np.int64), ("lat", np.float64), ("lon", np.float64)],
+    )
+    db.execute("DROP TABLE temp.refs;")
+    new = refs[~np.isin(refs, known["node_id"])]
+    in_file = np.array([n in h.nodes for n in new.tolist()], dtype=bool)
+    missing = new[~in_file]
+    broken = np.isin(node_from, missing) | np.isin(node_to, missing)
+    broken = np.unique(way_id[broken])
+    _, edge, shared = way_segments(node_from, node_to, way_id)
+    keep = ~np.isin(way_id, broken) & (edge | shared)
+    if len(broken):
+        print(
+            f"{len(broken)} ways miss a node and keep their old edges: "
+            f"{broken.tolist()}"
+        )
+
+    new = new[in_file]
+    used = np.isin(new, node_from[keep]) | np.isin(new, node_to[keep])
+    new = new[used]
+    positions = np.array([h.nodes[n] for n in new.tolist()]).reshape(-1, 2)
+    segments = (
+        node_from[keep],
+        node_to[keep],
+        tag[keep],
+        way_id[keep],
+        new,
+        positions,
+    )
+    return segments, broken
+
+
+def insert_highways(db, node_from, node_to, tag, way_id, new, positions):
+    # A segment whose nodes have no edge yet, in either direction, becomes
+    # the edge of the way with the smallest id that has the segment; the
+    # other segments share an edge. A new segment with a smaller way id
+    # than the way of its edge becomes the heir of the edge.
+    db.add_nodes(
+        new.tolist(), positions[:, 0].tolist(), positions[:, 1].tolist()
+    )
+    db.assign_node_indexes()
+    db.make_temp_table(
+        "new_edges",
+        node_from=node_from,
+        node_to=node_to,
+        tag=tag,
+        way_id=way_id,
+    )
+    db.execute(
+        "INSERT INTO edges(node_from, node_to, tag, way_id) "
+        "SELECT node_from, node_to, tag, MIN(way_id) "
+        "FROM temp.new_edges AS n "
+        "WHERE NOT EXISTS (SELECT 1 FROM edges AS e "
+        "WHERE e.node_from = n.node_from AND e.node_to = n.node_to) "
+        "AND NOT EXISTS (SELECT 1 FROM edges AS e "
+        "WHERE e.node_from = n.node_to AND e.node_to = n.node_from) "
+        "GROUP BY MIN(node_from, node_to), MAX(node_from, node_to);"
+    )
+    for a, b in (("node_from", "node_to"), ("node_to", "node_from")):
+        db.execute(
+            "INSERT INTO shared_edges(way_id, node_from, node_to, tag) "
+            "SELECT n.way_id, e.node_from, e.node_to, n.tag "
+            "FROM temp.new_edges AS n "
+            f"JOIN edges AS e ON e.node_from = n.{a} AND e.node_to = n.{b} "
+            "WHERE e.way_id != n.way_id;"
+        )
+    db.execute("DROP TABLE temp.new_edges;")
+    db.execute(
+        heirs_sql
+        + "WHERE s.way_id IN (SELECT way_id FROM temp.changed_ways) "
+        + "GROUP BY edges.id HAVING MIN(s.way_id) < edges.way_id;"
+    )
+    db.execute(
+        "INSERT INTO shared_edges(way_id, node_from, node_to, tag) "
+        "SELECT old_way_id, node_from, node_to, old_tag FROM temp.heirs;"
+    )
+    hand_over(db)
+
+
+def prune(db):
+    # Like the full import, keep only the largest component. The ids of
+    # the removed edges end up in temp.pruned.
+    edges = db.execute_array(
+        "SELECT id, node_from, node_to FROM edges;",
+        [("id", np.int64), ("node_from", np.int64), ("node_to", np.int64)],
+    )
+    keep = largest_component(edges["node_from"], edges["node_to"])
+    db.make_temp_table("pruned", id=edges["id"][~keep])
+
+
+def select_neighbourhood(db, points):
+    # Add the edges near the (latitude, longitude) points to the changed
+    # edges. The points are gathered in cells of neighbourhood meters, and
+    # the R*Tree gives the nodes in a box around each cell.
+    if len(points) == 0:
+        return
+    x, y = geo.project(points[:, 0], points[:, 1])
+    cells = np.unique(
+        np.column_stack([x // neighbourhood, y // neighbourhood]), axis=0
+    )
+    x0 = (cells[:, 0] - 1) * neighbourhood
+    y0 = (cells[:, 1] - 1) * neighbourhood
+    x1, y1 = x0 + 3 * neighbourhood, y0 + 3 * neighbourhood
+    # invert geo.project
+    lon_scale = np.sqrt(geo.factor) * geo.CR
+    db.make_temp_table(
+        "boxes",
+        min_lat=y0 / geo.CR,
+        max_lat=y1 / geo.CR,
+        min_lon=x0 / lon_scale,
+        max_lon=x1 / lon_scale,
+    )
+    for end in ("node_from", "node_to"):
+        db.execute(
+            "INSERT OR IGNORE INTO temp.changed_edges "
+            "SELECT edges.id FROM temp.boxes AS b "
+            "JOIN node_rtree AS r ON r.max_lat >= b.min_lat "
+            "AND r.min_lat <= b.max_lat "
+            "AND r.max_lon >= b.min_lon "
+            "AND r.min_lon <= b.max_lon "
+            "JOIN nodes ON nodes.id = r.id "
+            f"JOIN edges ON edges.{end} = nodes.node_id;"
+        )
+    db.execute("DROP TABLE temp.boxes;")
+
+
+def apply_changes(db, fname):
+    # In a single transaction, so that a crash leaves the tables as they
+    # were.
+    t.tic()
+    tables = [r[0] for r in db.execute("SELECT name FROM sqlite_master;")]
+    columns = [c[1] for c in db.execute("PRAGMA table_info(edges);")]
+    if "way_id" not in columns or "shared_edges" not in tables:
+        raise ValueError("The edges have no way ids, rebuild the database")
+    h = Change_Handler()
+    h.apply_file(fname)
+    print(f"{fname}: {len(h.nodes)} nodes and {len(h.ways)} ways changed")
+
+    with db.bulk_load():
+        edges, broken = changed_highways(db, h)
+        positions = np.array(list(h.nodes.values())).reshape(-1, 2)
+        db.make_temp_table(
+            "changed_nodes",
+            node_id=list(h.nodes),
+            latitude=positions[:, 0],
+            longitude=positions[:, 1],
+        )
+        db.make_temp_table(
+            "changed_ways", way_id=[w for w in h.ways if w not in broken]
+        )
+        db.execute(
+            "CREATE INDEX temp.changed_nodes_id ON changed_nodes(node_id);"
+        )
+        db.execute("CREATE INDEX temp.changed_ways_id ON changed_ways(way_id);")
+        db.execute("CREATE TEMP TABLE changed_edges (id INTEGER PRIMARY KEY);")
+
+        # the roads as they were
+        select_changed_edges(db)
+        ends = [road_ends(db, "changed_edges")]
+
+        delete_ways(db)
+        db.execute(
+            "UPDATE nodes SET latitude = c.latitude, longitude = c.longitude "
+            "FROM temp.changed_nodes AS c WHERE nodes.node_id = c.node_id;"
+        )
+        insert_highways(db, *edges)
+        db.execute(
+            "INSERT OR REPLACE INTO node_rtree "
+            "SELECT id, latitude, latitude, longitude, longitude FROM nodes "
+            "WHERE node_id IN (SELECT node_id FROM temp.changed_nodes);"
+        )
+        prune(db)
+        ends.append(road_ends(db, "pruned"))
+        db.execute(
+            "DELETE FROM shared_edges WHERE (node_from, node_to) IN "
+            "(SELECT node_from, node_to FROM edges "
+            "WHERE id IN (SELECT id FROM temp.pruned));"
+        )
+        db.execute(
+            "DELETE FROM edges WHERE id IN (SELECT id FROM temp.pruned);"
+        )
+
+        # the roads as they are; the edges that changed hands are still in
+        # the changed edges
+        select_changed_edges(db)
+        ends.append(road_ends(db, "changed_edges"))
+        num_changed = db.execute("SELECT COUNT(*) FROM temp.changed_edges;")
+        select_neighbourhood(db, np.concatenate(ends))
+        num_edges = db.execute("SELECT COUNT(*) FROM temp.changed_edges;")
+        print(f"{num_changed[0][0]} edges changed, {num_edges[0][0]} to update")
+        t.toc()
+
+        where = "edges.id IN (SELECT id FROM temp.changed_edges)"
+        compute_edge_length(db, where)
+        compute_road_distances(db, where)
+        scenery.compute_scenic(db, where=where)
+        compute_edge_cost(db, where)
+        for table in ("changed_nodes", "changed_ways", "changed_edges"):
+            db.execute(f"DROP TABLE temp.{table};")
+        db.execute("DROP TABLE temp.pruned;")
+    t.toc()
+
+
+def refresh_indexes(db):
+    # The snapshot and the snap index are rebuilt from the tables, as are
+    # the compressed graph and the tiles when they exist. Rebuilding the
+    # hierarchy would take longer than the update; as it no longer fits
+    # the costs, it is removed, and ch.py builds it again.
+    if common.storage == "columns":
+        export_columns(db)
+    build_snapshot(db)
+    G = Graph()
+    build_snap_index(G)
+    if os.path.exists(common.compressed_dir):
+        compress(G)
+    if os.path.exists(common.tiles_dir):
+        build_tiles(G)
+    if os.path.exists(common.ch_dir):
+        shutil.rmtree(common.ch_dir)
+        print(f"{common.ch_dir} removed, run ch.py to build the hierarchy")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Apply OpenStreetMap change files to the database."
+    )
+    parser.add_argument(
+        "changes", nargs="+", help=".osc or .osc.gz files, oldest first"
+    )
+    args = parser.parse_args()
+
+    db = DB()
+    for fname in args.changes:
+        apply_changes(db, fname)
+    refresh_indexes(db)
+    db.close_connection()
+
+
+if __name__ == '__main__':
+    main()